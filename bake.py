@@ -0,0 +1,60 @@
+"""Bakes a pretrained NeRF/BARF model into a sparse voxel octree for MLP-free (CPU) rendering."""
+
+import importlib
+import os,sys
+
+import options
+import torch
+
+from util import log
+
+# python3 bake.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue --data.val_sub= --resume
+#
+# the baked graph renders like any other backend, e.g. the novel views of evaluate.py (generate_videos_synthesis)
+# to compare with the ones of the trained model (under another --name, since they are written to the output path):
+#     --arch.backend=octree --load=output/strayscanner/statue_2/model_octree.ckpt
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (baking a NeRF/BARF model into a sparse voxel octree)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+    assert(opt.arch.backend=="mlp"),"the baked model should be an MLP NeRF"
+    # test-time pose optimization needs gradients through the MLPs
+    opt.optim.test_photo = False
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_pretrained(opt)
+
+        log.info("evaluating trained model...")
+        res_mlp = m.evaluate_test_split(opt)
+        # replace each NeRF of the graph by its baked octree
+        opt.arch.backend = "octree"
+        for name in ["nerf","nerf_fine"] if opt.nerf.fine_sampling else ["nerf"]:
+            log.info("baking {} (depth {})...".format(name,opt.arch.octree.depth))
+            octree = m.graph.build_nerf(opt).to(opt.device)
+            octree.bake(opt,getattr(m.graph,name))
+            setattr(m.graph,name,octree)
+        log.info("evaluating baked model...")
+        res_octree = m.evaluate_test_split(opt)
+
+        print("--------------------------")
+        print("{:>8} {:>10} {:>8} {:>8}".format("model","time (s)","PSNR","SSIM"))
+        for name,res in [("mlp",res_mlp),("octree",res_octree)]:
+            print("{:>8} {:>10.1f} {:>8.2f} {:>8.4f}".format(name,res.time,res.psnr,res.ssim))
+        print("speedup: {:.2f}x, PSNR delta: {:+.2f}, SSIM delta: {:+.4f}".format(res_mlp.time/res_octree.time,res_octree.psnr-res_mlp.psnr,res_octree.ssim-res_mlp.ssim))
+        size = sum(buffer.numel()*buffer.element_size() for buffer in m.graph.nerf.buffers())/2**20
+        print("octree size: {:.1f}MB".format(size))
+        print("--------------------------")
+
+        ckpt_fname = "{}/model_octree.ckpt".format(opt.output_path)
+        log.info("saving baked model to {}...".format(ckpt_fname))
+        torch.save(dict(epoch=None,iter=None,graph=m.graph.state_dict()),ckpt_fname)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,253 @@
+import numpy as np
+import os,sys,time
+import torch
+import torch.nn.functional as torch_F
+import importlib
+import tqdm
+from easydict import EasyDict as edict
+
+import options
+import util
+from util import log
+
+# python3 benchmark.py sampler --group=strayscanner --model=barf
+#                              --yaml=barf_strayscanner
+#                              --name=bench --data.scene=statue --max_iter=2000
+#
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (PyTorch code for benchmarking NeRF/BARF)".format(sys.argv[0]))
+
+    assert(len(sys.argv)>1 and not sys.argv[1].startswith("--")),"usage: python3 benchmark.py <benchmark> [--options]"
+    benchmark = globals()["benchmark_{}".format(sys.argv[1])]
+    opt_cmd = options.parse_arguments(sys.argv[2:])
+    opt = options.set(opt_cmd=opt_cmd)
+
+    with torch.cuda.device(opt.device):
+        benchmark(opt)
+
+def synchronize(opt):
+    if opt.device!="cpu": torch.cuda.synchronize()
+
+def train_for_benchmark(opt,m,val_freq=None):
+    # rebuild the networks and train them from scratch for opt.max_iter iterations (no logging/checkpointing),
+    # recording the test PSNR over the training time every val_freq iterations (if given)
+    torch.manual_seed(opt.seed)
+    m.build_networks(opt)
+    m.setup_optimizer(opt)
+    m.graph.train()
+    m.it,m.ep = 0,0
+    m.timer = edict(start=time.time(),it_mean=None)
+    # count the points evaluated by the MLP (in training)
+    stats = edict(points=0,time=0,curve=[])
+    forward = m.graph.nerf.forward
+    def forward_counted(opt,points_3D,*args,**kwargs):
+        if torch.is_grad_enabled(): stats.points += points_3D.numel()//3
+        return forward(opt,points_3D,*args,**kwargs)
+    m.graph.nerf.forward = forward_counted
+    loader = tqdm.trange(opt.max_iter,desc="training",leave=False)
+    synchronize(opt)
+    util.get_peak_memory(opt,reset=True)
+    time_start = time.time()
+    for it in loader:
+        m.train_iteration(opt,m.train_data.all,loader)
+        if opt.optim.sched: m.sched.step()
+        if val_freq and ((it+1)%val_freq==0 or it+1==opt.max_iter):
+            # validation time is not counted
+            synchronize(opt)
+            stats.time += time.time()-time_start
+            stats.curve.append((stats.time,evaluate_psnr(opt,m)))
+            m.graph.train()
+            time_start = time.time()
+    synchronize(opt)
+    stats.time += time.time()-time_start
+    stats.memory = util.get_peak_memory(opt)
+    del m.graph.nerf.forward
+    return stats
+
+@torch.no_grad()
+def evaluate_psnr(opt,m):
+    m.graph.eval()
+    psnr = []
+    for batch in m.test_loader:
+        var = edict(batch)
+        var = util.move_to_device(var,opt.device)
+        var = m.graph.forward(opt,var,mode="val")
+        image = var.image.view(len(var.idx),3,opt.H*opt.W).permute(0,2,1)
+        mse = ((var.rgb-image)**2).mean(dim=[1,2])
+        psnr += (-10*mse.log10()).tolist()
+    return np.mean(psnr)
+
+def benchmark_sampler(opt):
+    # compare the fixed depth-guided sampler against per-ray sample budgets (PSNR per second of training)
+    assert(opt.depth.use_depth),"the sampler benchmark requires depth-guided sampling (--depth.use_depth)"
+    opt.freq.scalar = opt.freq.vis = opt.max_iter+1 # no logging
+    model = importlib.import_module("model.{}".format(opt.model))
+    m = model.Model(opt)
+    m.load_dataset(opt,eval_split="test")
+    res = edict()
+    for name,packed,budget in [("fixed",opt.nerf.packed,False),("budget",True,True)]:
+        log.info("benchmarking sampler: {}".format(name))
+        opt.nerf.packed,opt.depth.budget.enabled = packed,budget
+        stats = train_for_benchmark(opt,m)
+        stats.psnr = evaluate_psnr(opt,m)
+        res[name] = stats
+    print("--------------------------")
+    print("{:>8} {:>10} {:>14} {:>8} {:>10}".format("sampler","time (s)","MLP pts/iter","PSNR","PSNR/sec"))
+    for name,stats in res.items():
+        print("{:>8} {:>10.1f} {:>14.0f} {:>8.2f} {:>10.4f}".format(name,stats.time,stats.points/opt.max_iter,stats.psnr,stats.psnr/stats.time))
+    print("--------------------------")
+
+def benchmark_backend(opt):
+    # time-to-PSNR of the radiance field backends: training time until reaching the final PSNR of the MLP backend,
+    # with the model size, the peak training memory and the training samples per second
+    opt.freq.scalar = opt.freq.vis = opt.max_iter+1 # no logging
+    model = importlib.import_module("model.{}".format(opt.model))
+    m = model.Model(opt)
+    m.load_dataset(opt,eval_split="test")
+    backend = opt.arch.backend
+    res = edict()
+    for name in ["mlp","hashgrid","tensorf"]:
+        log.info("benchmarking backend: {}".format(name))
+        opt.arch.backend = name
+        res[name] = train_for_benchmark(opt,m,val_freq=opt.freq.val)
+        res[name].size = sum(p.numel()*p.element_size() for p in m.graph.nerf.parameters())/2**20
+    psnr_target = res.mlp.curve[-1][1]
+    print("--------------------------")
+    print("{:>9} {:>10} {:>10} {:>11} {:>10} {:>8} {:>16} {:>8}".format("backend","size (MB)","peak (MB)","samples/s","time (s)","PSNR","time to MLP (s)","speedup"))
+    for name,stats in res.items():
+        time_target = next((t for t,psnr in stats.curve if psnr>=psnr_target),None)
+        print("{:>9} {:>10.1f} {:>10.1f} {:>11.0f} {:>10.1f} {:>8.2f}".format(name,stats.size,stats.memory,stats.points/stats.time,stats.time,stats.curve[-1][1]),end=" ")
+        if time_target is None: print("{:>16} {:>8}".format("-","-"))
+        else: print("{:>16.1f} {:>8.2f}".format(time_target,res.mlp.time/time_target))
+    print("--------------------------")
+    opt.arch.backend = backend
+
+def measure(opt,func,num_calls=100):
+    # average time (ms) and allocated memory (MB) per call
+    func()
+    synchronize(opt)
+    time_start = time.time()
+    for _ in range(num_calls): func()
+    synchronize(opt)
+    time_call = (time.time()-time_start)/num_calls*1000
+    if opt.device!="cpu":
+        torch.cuda.reset_peak_memory_stats()
+        memory_start = torch.cuda.memory_allocated()
+        func()
+        memory_call = (torch.cuda.max_memory_allocated()-memory_start)/2**20
+    else:
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            func()
+        memory_call = sum(max(e.cpu_memory_usage,0) for e in prof.function_events)/2**20
+    return time_call,memory_call
+
+@torch.no_grad()
+def benchmark_sample_depth(opt):
+    # time and memory per call of the depth samplers on a batch of random rays
+    graph = importlib.import_module("model.{}".format(opt.model)).Graph(opt).to(opt.device)
+    batch_size,num_rays = 1,opt.nerf.rand_rays
+    ray_idx = torch.arange(num_rays,device=opt.device)
+    near = torch.rand(batch_size,num_rays,device=opt.device)*2+2
+    far = near+torch.rand(batch_size,num_rays,device=opt.device)*0.4
+    confidence = torch.randint(0,3,(batch_size,num_rays),device=opt.device)
+    pdf = torch_F.softmax(torch.randn(batch_size,num_rays,opt.nerf.sample_intvs,device=opt.device),dim=-1)
+    samplers = edict(
+        uniform=lambda: graph.sample_depth(opt,batch_size,num_rays=num_rays,ray_idx=ray_idx),
+        depth=lambda: graph.sample_depth(opt,batch_size,num_rays=num_rays,ray_idx=ray_idx,confidence=confidence,near=near,far=far),
+        pdf=lambda: graph.sample_depth_from_pdf(opt,pdf=pdf),
+    )
+    use_depth,opt.depth.use_depth = opt.depth.use_depth,True
+    opt.nerf.sample_intvs_fine = opt.nerf.sample_intvs_fine or opt.nerf.sample_intvs
+    print("--------------------------")
+    print("{:>8} {:>10} {:>12}".format("sampler","time (ms)","memory (MB)"))
+    for name,func in samplers.items():
+        time_call,memory_call = measure(opt,func)
+        print("{:>8} {:>10.3f} {:>12.2f}".format(name,time_call,memory_call))
+    print("--------------------------")
+    opt.depth.use_depth = use_depth
+
+@torch.no_grad()
+def benchmark_render_workers(opt):
+    # time of rendering full views with 1 to N render workers (slices/views on a thread pool)
+    graph = importlib.import_module("model.{}".format(opt.model)).Graph(opt).to(opt.device)
+    graph.eval()
+    num_views = 4
+    pose = torch.eye(3,4,device=opt.device).repeat(num_views,1,1)
+    pose[:,2,3] = torch.linspace(3,4,num_views)
+    intr = torch.tensor([[opt.W,0,opt.W/2],[0,opt.W,opt.H/2],[0,0,1]],dtype=torch.float32,device=opt.device)[None]
+    max_workers = os.cpu_count()
+    workers_list = sorted(set([1]+[2**i for i in range(1,max_workers.bit_length()) if 2**i<=max_workers]+[max_workers]))
+    render_workers = opt.nerf.render_workers
+    print("--------------------------")
+    print("{:>8} {:>10} {:>10}".format("workers","time (ms)","speedup"))
+    for num_workers in workers_list:
+        opt.nerf.render_workers = num_workers
+        time_call,_ = measure(opt,lambda: graph.render_views(opt,pose,intr=intr),num_calls=3)
+        if num_workers==1: time_serial = time_call
+        print("{:>8} {:>10.1f} {:>10.2f}".format(num_workers,time_call,time_serial/time_call))
+    print("--------------------------")
+    opt.nerf.render_workers = render_workers
+    importlib.import_module("model.nerf").shutdown_render_pool()
+
+def benchmark_checkpoint(opt):
+    # training speed and peak memory with/without activation checkpointing of the MLPs, at several ray counts
+    graph = importlib.import_module("model.{}".format(opt.model)).Graph(opt).to(opt.device)
+    graph.train()
+    optim = torch.optim.Adam(graph.parameters(),lr=opt.optim.lr)
+    pose = torch.eye(3,4,device=opt.device)[None]
+    pose[:,2,3] = 4
+    intr = torch.tensor([[opt.W,0,opt.W/2],[0,opt.W,opt.H/2],[0,0,1]],dtype=torch.float32,device=opt.device)[None]
+    rand_rays,checkpoint = opt.nerf.rand_rays,opt.nerf.checkpoint.enabled
+    def train_step():
+        ray_idx = torch.randperm(opt.H*opt.W,device=opt.device)[:opt.nerf.rand_rays]
+        ret = graph.render(opt,pose,intr=intr,ray_idx=ray_idx,mode="train")
+        loss = ((ret.rgb-0.5)**2).mean()
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+    print("--------------------------")
+    print("{:>8} {:>11} {:>8} {:>12}".format("rays","checkpoint","it/s","peak (MB)"))
+    for num_rays in [rand_rays//2,rand_rays,rand_rays*2,rand_rays*4]:
+        for enabled in [False,True]:
+            opt.nerf.rand_rays,opt.nerf.checkpoint.enabled = num_rays,enabled
+            train_step()
+            synchronize(opt)
+            util.get_peak_memory(opt,reset=True)
+            time_start = time.time()
+            for _ in range(5): train_step()
+            synchronize(opt)
+            speed = 5/(time.time()-time_start)
+            print("{:>8} {:>11} {:>8.2f} {:>12.1f}".format(num_rays,str(enabled),speed,util.get_peak_memory(opt)))
+    print("--------------------------")
+    opt.nerf.rand_rays,opt.nerf.checkpoint.enabled = rand_rays,checkpoint
+
+@torch.no_grad()
+def benchmark_frozen(opt):
+    # time of NeRF.forward on one render chunk and of a full view, eager vs. the frozen module (per backend)
+    graph = importlib.import_module("model.{}".format(opt.model)).Graph(opt).to(opt.device)
+    graph.eval()
+    num_points = (opt.nerf.render_chunk or opt.nerf.rand_rays)*opt.nerf.sample_intvs
+    points_3D = torch.rand(1,num_points,3,device=opt.device)*2-1 # [1,N,3]
+    ray_unit = torch_F.normalize(torch.randn(1,num_points,3,device=opt.device),dim=-1) # [1,N,3]
+    pose = torch.eye(3,4,device=opt.device)[None]
+    pose[:,2,3] = 4
+    intr = torch.tensor([[opt.W,0,opt.W/2],[0,opt.W,opt.H/2],[0,0,1]],dtype=torch.float32,device=opt.device)[None]
+    backends = ["eager","script"]+(["compile"] if hasattr(torch,"compile") else [])
+    frozen = opt.nerf.frozen
+    print("--------------------------")
+    print("{:>16} {:>12} {:>10} {:>10}".format("module","forward (ms)","view (ms)","speedup"))
+    for name,enabled,backend in [("eager",False,frozen.backend)]+[("frozen-"+b,True,b) for b in backends]:
+        opt.nerf.frozen = edict(enabled=enabled,backend=backend)
+        graph.nerf.reset_frozen()
+        time_forward,_ = measure(opt,lambda: graph.nerf.forward(opt,points_3D,ray_unit=ray_unit,mode="eval"),num_calls=10)
+        time_view,_ = measure(opt,lambda: graph.render_views(opt,pose,intr=intr),num_calls=3)
+        if not enabled: time_eager = time_view
+        print("{:>16} {:>12.1f} {:>10.1f} {:>10.2f}".format(name,time_forward,time_view,time_eager/time_view))
+    print("--------------------------")
+    opt.nerf.frozen = frozen
+    graph.nerf.reset_frozen()
+
+if __name__=="__main__":
+    main()
@@ -3,6 +3,7 @@ import os,sys,time
 import torch
 import torch.nn.functional as torch_F
 import collections
+import threading
 from easydict import EasyDict as edict
 
 import util
@@ -231,24 +232,39 @@ def angle_to_rotation_matrix(a,axis):
     M = M.roll((roll,roll),dims=(-2,-1))
     return M
 
-def get_center_and_ray(opt,pose,intr=None): # [HW,2]
-    # given the intrinsic/extrinsic matrices, get the camera center and ray directions]
+def get_camera_rays(opt,intr): # [B,3,3]
+    # camera-space ray directions (at z=1) of all pixels, cached per image size and intrinsics
+    # (the render workers call this concurrently, so the cache is only accessed under the lock)
+    key = (opt.H,opt.W,str(intr.device),intr.detach().cpu().numpy().tobytes())
+    with camera_ray_lock:
+        ray_cam = camera_ray_cache.get(key)
+    if ray_cam is None:
+        with torch.no_grad():
+            # compute image coordinate grid
+            y_range = torch.arange(opt.H,dtype=torch.float32,device=intr.device).add_(0.5)
+            x_range = torch.arange(opt.W,dtype=torch.float32,device=intr.device).add_(0.5)
+            Y,X = torch.meshgrid(y_range,x_range) # [H,W]
+            xy_grid = torch.stack([X,Y],dim=-1).view(-1,2) # [HW,2]
+            # share the table across the batch if all images have the same intrinsics
+            if (intr==intr[:1]).all(): intr = intr[:1]
+            ray_cam = img2cam(to_hom(xy_grid),intr) # [B,HW,3] or [1,HW,3]
+        with camera_ray_lock:
+            if len(camera_ray_cache)>=8: camera_ray_cache.clear()
+            camera_ray_cache[key] = ray_cam
+    return ray_cam
+camera_ray_cache = {}
+camera_ray_lock = threading.Lock()
+
+def get_center_and_ray(opt,pose,intr=None,ray_idx=None): # [HW,2]
+    # given the intrinsic/extrinsic matrices, get the camera center and ray directions (only for the pixels in ray_idx if given)
     assert(opt.camera.model=="perspective")
-    with torch.no_grad():
-        # compute image coordinate grid
-        y_range = torch.arange(opt.H,dtype=torch.float32,device=opt.device).add_(0.5)
-        x_range = torch.arange(opt.W,dtype=torch.float32,device=opt.device).add_(0.5)
-        Y,X = torch.meshgrid(y_range,x_range) # [H,W]
-        xy_grid = torch.stack([X,Y],dim=-1).view(-1,2) # [HW,2]
-    # compute center and ray
-    batch_size = len(pose)
-    xy_grid = xy_grid.repeat(batch_size,1,1) # [B,HW,2]
-    grid_3D = img2cam(to_hom(xy_grid),intr) # [B,HW,3]
-    center_3D = torch.zeros_like(grid_3D) # [B,HW,3]
-    # transform from camera to world coordinates
-    grid_3D = cam2world(grid_3D,pose) # [B,HW,3]
-    center_3D = cam2world(center_3D,pose) # [B,HW,3]
-    ray = grid_3D-center_3D # [B,HW,3]
+    ray_cam = get_camera_rays(opt,intr) # [B,HW,3]
+    if ray_idx is not None: ray_cam = ray_cam[:,ray_idx] # [B,R,3]
+    # transform from camera to world coordinates (x_world = R^T(x_cam-t))
+    R,t = pose[...,:3],pose[...,3:] # [B,3,3],[B,3,1]
+    ray = ray_cam@R # [B,R,3]
+    center_3D = (-R.transpose(-1,-2)@t)[...,0] # [B,3]
+    center_3D = center_3D[:,None].expand_as(ray) # [B,R,3]
     return center_3D,ray
 
 def get_3D_points_from_depth(opt,center,ray,depth,multi_samples=False):
@@ -0,0 +1,57 @@
+"""Distills a pretrained NeRF/BARF model into a grid of tiny MLPs (KiloNeRF) for fast inference."""
+
+import importlib
+import os,sys
+
+import options
+import torch
+
+from util import log
+
+# python3 distill.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue --data.val_sub= --resume
+#
+# the distilled graph renders like any other backend (and can be fine-tuned with train.py):
+#     --arch.backend=kilonerf --load=output/strayscanner/statue_2/model_kilonerf.ckpt
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (distilling a NeRF/BARF model into tiny MLPs)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+    assert(opt.arch.backend=="mlp"),"the distilled (teacher) model should be an MLP NeRF"
+    # test-time pose optimization needs gradients through the MLPs
+    opt.optim.test_photo = False
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_pretrained(opt)
+
+        log.info("evaluating teacher model...")
+        res_teacher = m.evaluate_test_split(opt)
+        # replace each NeRF of the graph by its distilled grid of tiny MLPs
+        opt.arch.backend = "kilonerf"
+        for name in ["nerf","nerf_fine"] if opt.nerf.fine_sampling else ["nerf"]:
+            log.info("distilling {} ({}^3 cells)...".format(name,opt.arch.kilonerf.res))
+            student = m.graph.build_nerf(opt).to(opt.device)
+            student.distill(opt,getattr(m.graph,name))
+            setattr(m.graph,name,student)
+        log.info("evaluating distilled model...")
+        res_student = m.evaluate_test_split(opt)
+
+        print("--------------------------")
+        print("{:>8} {:>10} {:>8} {:>8}".format("model","time (s)","PSNR","SSIM"))
+        for name,res in [("teacher",res_teacher),("kilonerf",res_student)]:
+            print("{:>8} {:>10.1f} {:>8.2f} {:>8.4f}".format(name,res.time,res.psnr,res.ssim))
+        print("speedup: {:.2f}x, PSNR delta: {:+.2f}, SSIM delta: {:+.4f}".format(res_teacher.time/res_student.time,res_student.psnr-res_teacher.psnr,res_student.ssim-res_teacher.ssim))
+        print("--------------------------")
+
+        ckpt_fname = "{}/model_kilonerf.ckpt".format(opt.output_path)
+        log.info("saving distilled model to {}...".format(ckpt_fname))
+        torch.save(dict(epoch=None,iter=None,graph=m.graph.state_dict()),ckpt_fname)
+
+if __name__=="__main__":
+    main()
@@ -27,6 +27,10 @@ def main():
 
         m.load_dataset(opt,eval_split="test")
         m.build_networks(opt)
+        if opt.nerf.precision.type!="fp32":
+            # reduced-precision rendering only if the trained model passes the accuracy gate
+            m.restore_checkpoint(opt)
+            m.check_precision(opt)
 
         if opt.model=="barf":
 
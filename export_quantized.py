@@ -0,0 +1,51 @@
+"""Exports a pretrained NeRF/BARF model with int8 dynamically quantized MLPs for CPU inference."""
+
+import importlib
+import os,sys
+
+import options
+import torch
+
+from util import log
+
+# python3 export_quantized.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue --data.val_sub= --resume --cpu
+#
+# the exported graph is loaded back by quantizing a freshly built one first:
+#     m.build_networks(opt); m.graph.quantize(opt); m.graph.load_state_dict(torch.load(...))
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (exporting an int8 quantized NeRF/BARF model)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+    assert(opt.device=="cpu"),"dynamic int8 quantization is only supported on CPU (--cpu)"
+    assert(opt.arch.backend=="mlp"),"only the MLP NeRF can be quantized (the grid backends have no MLP stack to quantize)"
+    # test-time pose optimization needs gradients through the MLPs
+    opt.optim.test_photo = False
+
+    model = importlib.import_module("model.{}".format(opt.model))
+    m = model.Model(opt)
+    m.load_pretrained(opt)
+
+    log.info("evaluating fp32 model...")
+    res_fp32 = m.evaluate_test_split(opt)
+    log.info("quantizing MLPs (dynamic int8)...")
+    m.graph.quantize(opt)
+    log.info("evaluating int8 model...")
+    res_int8 = m.evaluate_test_split(opt)
+
+    print("--------------------------")
+    print("{:>6} {:>10} {:>8} {:>8}".format("model","time (s)","PSNR","SSIM"))
+    for name,res in [("fp32",res_fp32),("int8",res_int8)]:
+        print("{:>6} {:>10.1f} {:>8.2f} {:>8.4f}".format(name,res.time,res.psnr,res.ssim))
+    print("speedup: {:.2f}x, PSNR delta: {:+.2f}, SSIM delta: {:+.4f}".format(res_fp32.time/res_int8.time,res_int8.psnr-res_fp32.psnr,res_int8.ssim-res_fp32.ssim))
+    print("--------------------------")
+
+    ckpt_fname = "{}/model_int8.ckpt".format(opt.output_path)
+    log.info("saving quantized model to {}...".format(ckpt_fname))
+    torch.save(m.graph.state_dict(),ckpt_fname)
+
+if __name__=="__main__":
+    main()
@@ -33,8 +33,7 @@ with torch.cuda.device(opt.device),torch.no_grad():
     density_all = []
     for i in tqdm.trange(0,len(query_flat),opt.trimesh.chunk_size,leave=False):
         points = query_flat[None,i:i+opt.trimesh.chunk_size].to(opt.device)
-        ray_unit = torch.zeros_like(points) # dummy ray to comply with interface, not used
-        _,density_samples = m.graph.nerf.forward(opt,points,ray_unit=ray_unit,mode=None)
+        density_samples = m.graph.nerf.forward_density(opt,points,mode=None)
         density_all.append(density_samples.cpu())
     density_all = torch.cat(density_all,dim=1)[0]
     density_all = density_all.view(*query.shape[:-1]).numpy()
@@ -32,6 +32,12 @@ class Model(nerf.Model):
         self.graph.se3_refine = torch.nn.Embedding(len(self.train_data),6).to(opt.device) #TODO : refine되는 포즈?, (n,6) : 6개로 나타내나봐
         torch.nn.init.zeros_(self.graph.se3_refine.weight) #(n,6) shape의 0으로 채워진 행렬
 
+    def load_pretrained(self,opt):
+        super().load_pretrained(opt)
+        # align the test poses to the optimized coordinate system
+        pose,pose_GT = self.get_all_optitrack_training_poses(opt)
+        _,self.graph.sim3 = self.prealign_cameras(opt,pose,pose_GT)
+
     def setup_optimizer(self,opt):
         super().setup_optimizer(opt)
         optimizer = getattr(torch.optim,opt.optim.algo)  #Adam
@@ -52,7 +58,7 @@ class Model(nerf.Model):
             self.optim_pose.param_groups[0]["lr_orig"] = self.optim_pose.param_groups[0]["lr"] # cache the original learning rate
             self.optim_pose.param_groups[0]["lr"] *= min(1,self.it/opt.optim.warmup_pose)
         loss = super().train_iteration(opt,var,loader)
-        self.optim_pose.step()
+        if loss.all.requires_grad: self.optim_pose.step()
         if opt.optim.warmup_pose:
             self.optim_pose.param_groups[0]["lr"] = self.optim_pose.param_groups[0]["lr_orig"] # reset learning rate
         if opt.optim.sched_pose: self.sched_pose.step()
@@ -188,8 +194,9 @@ class Model(nerf.Model):
             loss = self.graph.compute_loss(opt,var,mode="test-optim")
             loss = self.summarize_loss(opt,var,loss)
             # loss.all.backward()
-            loss.all.backward(retain_graph=True)
-            optim_pose.step()
+            if loss.all.requires_grad:
+                loss.all.backward(retain_graph=True)
+                optim_pose.step()
             iterator.set_postfix(loss="{:.3f}".format(loss.all))
         return var
 
@@ -428,11 +435,12 @@ class Graph(nerf.Graph):
 
     def __init__(self,opt):
         super().__init__(opt)
-        self.nerf = NeRF(opt)
-        if opt.nerf.fine_sampling:
-            self.nerf_fine = NeRF(opt)
         self.pose_eye = torch.eye(3,4).to(opt.device)
 
+    def build_nerf(self,opt):
+        if opt.arch.backend=="mlp": return NeRF(opt)
+        return super().build_nerf(opt)
+
     def get_pose(self,opt,var,mode=None):
         if mode=="train":
             # add the pre-generated pose perturbations
@@ -472,15 +480,15 @@ class NeRF(nerf.NeRF):
         self.progress = torch.nn.Parameter(torch.tensor(0.)) # use Parameter so it could be checkpointed
 
     def positional_encoding(self,opt,input,L): # [B,...,N]
-        input_enc = super().positional_encoding(opt,input,L=L) # [B,...,2NL]
-        # coarse-to-fine: smoothly mask positional encoding for BARF
-        if opt.barf_c2f is not None:
-            # set weights for different frequency bands
-            start,end = opt.barf_c2f
-            alpha = (self.progress.data-start)/(end-start)*L
-            k = torch.arange(L,dtype=torch.float32,device=opt.device)
-            weight = (1-(alpha-k).clamp_(min=0,max=1).mul_(np.pi).cos_())/2
-            # apply weights
-            shape = input_enc.shape
-            input_enc = (input_enc.view(-1,L)*weight).view(*shape)
+        # coarse-to-fine: smoothly mask positional encoding for BARF (the weights only change with the progress)
+        weight = self.posenc.get_weight(L,self.progress.item(),lambda: self.get_c2f_weight(opt,L)) if opt.barf_c2f is not None else None
+        input_enc = self.posenc(input,L,weight=weight) # [B,...,2NL]
         return input_enc
+
+    def get_c2f_weight(self,opt,L):
+        # set weights for different frequency bands
+        start,end = opt.barf_c2f
+        alpha = (self.progress.data-start)/(end-start)*L
+        k = torch.arange(L,dtype=torch.float32,device=opt.device)
+        weight = (1-(alpha-k).clamp_(min=0,max=1).mul_(np.pi).cos_())/2
+        return weight # [L]
@@ -117,8 +117,10 @@ class Model():
         var = self.graph.forward(opt,var,mode="train")
         loss = self.graph.compute_loss(opt,var,mode="train")
         loss = self.summarize_loss(opt,var,loss)
-        loss.all.backward()
-        self.optim.step()
+        # skip the update if nothing in the batch depends on the parameters (e.g. no sample in an occupied cell of a distilled grid)
+        if loss.all.requires_grad:
+            loss.all.backward()
+            self.optim.step()
         # after train iteration
         if (self.it+1)%opt.freq.scalar==0: self.log_scalars(opt,var,loss,step=self.it+1,split="train")
         if (self.it+1)%opt.freq.vis==0: self.visualize(opt,var,step=self.it+1,split="train")
@@ -226,13 +228,19 @@ class Graph(torch.nn.Module):
 
         if pred_depth_mean.shape[0] == 0:
             return torch.zeros((1,), device=pred_depth.device, requires_grad=True)
-        z_vals = z_vals.squeeze(dim=-1) #(1,-,128,1) -> #(1,49152,128)
-        weights = weights.squeeze(dim=-1) # #(1,49152,128)
+        if isinstance(z_vals,dict):
+            # packed samples (z_vals.depth : [S,1], weights : [S,1]), sum the weighted deviations per ray
+            deviation = (z_vals.depth[:,0]-pred_depth.view(-1)[z_vals.ray_id]).pow(2)*weights[:,0] # [S]
+            pre_confi = deviation.new_zeros(pred_depth.numel()).index_add(0,z_vals.ray_id,deviation) # [batch*H*W]
+            pre_confi = pre_confi.view(apply_depth_loss.shape)[apply_depth_loss] + 1e-5
+        else:
+            z_vals = z_vals.squeeze(dim=-1) #(1,-,128,1) -> #(1,49152,128)
+            weights = weights.squeeze(dim=-1) # #(1,49152,128)
 
 
-        pre_confi = ((z_vals[apply_depth_loss] - pred_depth_mean).pow(2) * weights[apply_depth_loss]).sum(-1) + 1e-5
-                        # # (30278,128) - # (30278,1,1)
-                        #  pow(2) : (30278,128)
+            pre_confi = ((z_vals[apply_depth_loss] - pred_depth_mean).pow(2) * weights[apply_depth_loss]).sum(-1) + 1e-5
+                            # # (30278,128) - # (30278,1,1)
+                            #  pow(2) : (30278,128)
         gt_depth = target_depth.squeeze(dim=-1)[apply_depth_loss]  #(-,1) -> (-)
         cnt_all = target_depth.shape[0] * target_depth.shape[1]
         pred_depth_mean = pred_depth_mean.squeeze(dim=-1)
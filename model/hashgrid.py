@@ -0,0 +1,135 @@
+import numpy as np
+import torch
+import torch.nn.functional as torch_F
+
+import util
+from util import log,debug
+from . import nerf
+
+# ============================ multi-resolution hash-grid radiance field ============================
+
+class NeRF(nerf.NeRF):
+    # hashed multi-resolution feature grid with tiny MLPs (opt.arch.backend=hashgrid),
+    # with the same forward contract as the MLP NeRF (sampling/compositing/pose refinement are shared)
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.progress = torch.nn.Parameter(torch.tensor(0.)) # coarse-to-fine over the grid levels (BARF), use Parameter so it could be checkpointed
+
+    def define_network(self,opt):
+        cfg = opt.arch.hashgrid
+        self.grid = HashGrid(opt)
+        if opt.nerf.view_dep:
+            input_view_dim = 3+6*opt.arch.posenc.L_view if opt.arch.posenc else 3
+        # density and geometric features from the grid features
+        self.mlp_feat = torch.nn.ModuleList()
+        L = util.get_layer_dims(cfg.layers_feat)
+        for li,(k_in,k_out) in enumerate(L):
+            if li==0: k_in = cfg.levels*cfg.features
+            if li==len(L)-1:
+                # volume density and features (or the spherical harmonics colors)
+                k_out = 1+3*self.get_num_sh(opt) if opt.arch.color=="sh" else k_out+1
+            linear = torch.nn.Linear(k_in,k_out)
+            if opt.arch.tf_init:
+                self.tensorflow_init_weights(opt,linear,out="first" if li==len(L)-1 else None)
+            self.mlp_feat.append(linear)
+        # RGB prediction
+        self.mlp_rgb = torch.nn.ModuleList()
+        if opt.arch.color=="sh": return
+        L = util.get_layer_dims(cfg.layers_rgb)
+        feat_dim = cfg.layers_feat[-1]
+        for li,(k_in,k_out) in enumerate(L):
+            if li==0: k_in = feat_dim+(input_view_dim if opt.nerf.view_dep else 0)
+            linear = torch.nn.Linear(k_in,k_out)
+            if opt.arch.tf_init:
+                self.tensorflow_init_weights(opt,linear,out="all" if li==len(L)-1 else None)
+            self.mlp_rgb.append(linear)
+
+    def get_param_groups(self,opt):
+        return [dict(params=self.parameters(),lr=opt.arch.hashgrid.lr)]
+
+    def forward(self,opt,points_3D,ray_unit=None,mode=None,ray_id=None): # [B,...,3]
+        # ray_unit: either broadcastable to points_3D (e.g. one direction per ray) or per ray and gathered with ray_id
+        feat,density = self.forward_geometry(opt,points_3D,mode=mode)
+        if opt.arch.color=="sh":
+            return self.get_sh_color(opt,feat,ray_unit=ray_unit,ray_id=ray_id),density
+        # predict RGB values
+        feat_view = self.get_view_feat(opt,feat.shape[-1],self.encode_view(opt,ray_unit),ray_id=ray_id)
+        feat = self.forward_rgb_layers(opt,range(len(self.mlp_rgb)),feat,feat_view)
+        rgb = feat.sigmoid_() # [B,...,3]
+        return rgb,density
+
+    def forward_density(self,opt,points_3D,mode=None): # [B,...,3]
+        _,density = self.forward_geometry(opt,points_3D,density_only=True,mode=mode)
+        return density
+
+    def forward_geometry(self,opt,points_3D,density_only=False,mode=None): # [B,...,3]
+        # coarse-to-fine: smoothly mask the finer grid levels for BARF
+        weight = self.get_c2f_weight(opt) if getattr(opt,"barf_c2f",None) is not None else None
+        feat = self.grid(opt,points_3D,weight=weight) # [B,...,LF]
+        for li,layer in enumerate(self.mlp_feat):
+            feat = layer(feat)
+            if li!=len(self.mlp_feat)-1:
+                feat = torch_F.relu(feat)
+        density = feat[...,0]
+        if opt.nerf.density_noise_reg and mode=="train":
+            density += torch.randn_like(density)*opt.nerf.density_noise_reg
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density_activ(density)
+        # empty space outside of the grid
+        range_min,range_max = opt.arch.hashgrid.range
+        density = density*((points_3D>=range_min)&(points_3D<=range_max)).all(dim=-1)
+        if density_only: return None,density
+        # (the spherical harmonics colors are not rectified)
+        feat = feat[...,1:] if opt.arch.color=="sh" else torch_F.relu(feat[...,1:])
+        return feat,density # [B,...,K],[B,...]
+
+    def get_c2f_weight(self,opt):
+        # same schedule as the BARF positional encoding, with the grid levels as frequency bands
+        start,end = opt.barf_c2f
+        L = opt.arch.hashgrid.levels
+        alpha = (self.progress.data-start)/(end-start)*L
+        k = torch.arange(L,dtype=torch.float32,device=opt.device)
+        weight = (1-(alpha-k).clamp_(min=0,max=1).mul_(np.pi).cos_())/2
+        return weight # [L]
+
+class HashGrid(torch.nn.Module):
+    # multi-resolution hash encoding (Instant-NGP): per level, trilinear interpolation of the features
+    # stored at the 8 cell corners, looked up in a hashed table (or directly for the levels that fit in it)
+
+    def __init__(self,opt):
+        super().__init__()
+        cfg = opt.arch.hashgrid
+        self.table_size = 2**cfg.log2_size
+        res_min,res_max = cfg.res
+        growth = np.exp((np.log(res_max)-np.log(res_min))/max(cfg.levels-1,1))
+        res = torch.tensor([int(np.round(res_min*growth**l)) for l in range(cfg.levels)]) # [L]
+        self.register_buffer("res",res,persistent=False)
+        self.register_buffer("dense",(res+1)**3<=self.table_size,persistent=False)
+        self.register_buffer("table_offset",torch.arange(cfg.levels)*self.table_size,persistent=False)
+        self.register_buffer("corners",torch.tensor([[i>>2&1,i>>1&1,i&1] for i in range(8)]),persistent=False)
+        self.register_buffer("primes",torch.tensor([1,2654435761,805459861]),persistent=False)
+        self.table = torch.nn.Parameter(torch.empty(cfg.levels*self.table_size,cfg.features).uniform_(-1e-4,1e-4)) # [LT,F]
+
+    def forward(self,opt,points_3D,weight=None): # [B,...,3]
+        shape = points_3D.shape
+        range_min,range_max = opt.arch.hashgrid.range
+        points = ((points_3D.reshape(-1,3)-range_min)/(range_max-range_min)).clamp(min=0,max=1) # [P,3]
+        # cell of each level and position inside it
+        pos = points[:,None]*self.res[:,None] # [P,L,3]
+        pos_floor = torch.minimum(pos.detach().floor(),(self.res-1)[:,None].float())
+        frac = pos-pos_floor # [P,L,3]
+        pos_floor = pos_floor.long()
+        stride = torch.stack([torch.ones_like(self.res),self.res+1,(self.res+1)**2],dim=-1) # [L,3]
+        feat = 0
+        for corner in self.corners:
+            index = pos_floor+corner # [P,L,3]
+            index_dense = (index*stride).sum(dim=-1) # [P,L]
+            index_hash = (index*self.primes).unbind(dim=-1)
+            index_hash = (index_hash[0]^index_hash[1]^index_hash[2])&(self.table_size-1) # [P,L]
+            index = torch.where(self.dense,index_dense,index_hash)+self.table_offset # [P,L]
+            weight_corner = torch.where(corner.bool(),frac,1-frac).prod(dim=-1,keepdim=True) # [P,L,1]
+            feat = feat+self.table[index]*weight_corner # [P,L,F]
+        if weight is not None: feat = feat*weight[:,None]
+        feat = feat.view(*shape[:-1],-1) # [B,...,LF]
+        return feat
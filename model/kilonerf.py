@@ -0,0 +1,201 @@
+import numpy as np
+import multiprocessing,concurrent.futures
+import torch
+import torch.nn.functional as torch_F
+import tqdm
+from easydict import EasyDict as edict
+
+import util
+from util import log,debug
+from . import nerf
+
+# ============================ grid of tiny MLPs distilled from a trained NeRF ============================
+
+class NeRF(nerf.NeRF):
+    # KiloNeRF: the scene range is split into res^3 cells, each with its own tiny MLP (opt.arch.backend=kilonerf),
+    # with the same forward contract as the MLP NeRF; the MLPs are fit to a trained model with distill()
+    # and empty cells (no MLP) have zero density
+
+    block_size = 256 # points per batched matrix multiplication (all from the same cell)
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.progress = torch.nn.Parameter(torch.tensor(0.)) # use Parameter so it could be checkpointed (BARF)
+
+    def define_network(self,opt):
+        cfg = opt.arch.kilonerf
+        num_cells = cfg.res**3
+        dims_feat,dims_rgb = get_layer_dims(opt)
+        # stacked weights/biases of the per-cell MLPs
+        layers_feat = [init_layer(num_cells,k_in,k_out) for k_in,k_out in dims_feat]
+        layers_rgb = [init_layer(num_cells,k_in,k_out) for k_in,k_out in dims_rgb]
+        self.feat_weights = torch.nn.ParameterList([torch.nn.Parameter(weight) for weight,_ in layers_feat]) # [C,K_in,K_out]
+        self.feat_biases = torch.nn.ParameterList([torch.nn.Parameter(bias) for _,bias in layers_feat]) # [C,1,K_out]
+        self.rgb_weights = torch.nn.ParameterList([torch.nn.Parameter(weight) for weight,_ in layers_rgb])
+        self.rgb_biases = torch.nn.ParameterList([torch.nn.Parameter(bias) for _,bias in layers_rgb])
+        self.register_buffer("occupied",torch.zeros(num_cells,dtype=torch.bool)) # cells with an MLP
+
+    def forward(self,opt,points_3D,ray_unit=None,mode=None,ray_id=None): # [B,...,3]
+        # ray_unit: either broadcastable to points_3D (e.g. one direction per ray) or per ray and gathered with ray_id
+        view_enc = None
+        if opt.nerf.view_dep:
+            assert(ray_unit is not None)
+            # encode the view directions once per ray
+            view_enc = self.encode(opt,ray_unit,L=opt.arch.posenc.L_view)
+            view_enc = view_enc[ray_id] if ray_id is not None else view_enc.expand(*points_3D.shape[:-1],-1) # [B,...,K]
+            view_enc = view_enc.reshape(-1,view_enc.shape[-1])
+        rgb,density = self.forward_cells(opt,points_3D.reshape(-1,3),view_enc=view_enc,mode=mode)
+        return rgb.view(*points_3D.shape[:-1],3),density.view(points_3D.shape[:-1]) # [B,...,3],[B,...]
+
+    def forward_density(self,opt,points_3D,mode=None): # [B,...,3]
+        _,density = self.forward_cells(opt,points_3D.reshape(-1,3),density_only=True,mode=mode)
+        return density.view(points_3D.shape[:-1]) # [B,...]
+
+    def forward_cells(self,opt,points_3D,view_enc=None,density_only=False,mode=None): # [P,3],[P,K]
+        # group the points of each cell into fixed-size blocks and evaluate all blocks with batched matrix multiplications
+        cell,valid = self.get_cell(opt,points_3D) # [P]
+        rgb = points_3D.new_zeros(len(points_3D),3) # [P,3]
+        density = points_3D.new_zeros(len(points_3D)) # [P]
+        idx = valid.nonzero()[:,0] # [M]
+        if not len(idx): return rgb,density
+        cell,order = cell[idx].sort()
+        idx = idx[order]
+        counts = torch.bincount(cell,minlength=len(self.occupied)) # [C]
+        blocks = (counts+self.block_size-1)//self.block_size # [C]
+        block_cell = torch.repeat_interleave(torch.arange(len(blocks),device=cell.device),blocks) # [G]
+        rank = torch.arange(len(idx),device=cell.device)-(counts.cumsum(dim=0)-counts)[cell] # [M]
+        block = (blocks.cumsum(dim=0)-blocks)[cell]+rank//self.block_size # [M]
+        slot = rank%self.block_size # [M]
+        def to_blocks(input): # [M,K]
+            output = input.new_zeros(len(block_cell),self.block_size,input.shape[-1]) # [G,S,K]
+            output[block,slot] = input
+            return output
+        points_enc = to_blocks(self.encode(opt,points_3D[idx],L=opt.arch.posenc.L_3D))
+        layers_feat = [(weight[block_cell],bias[block_cell]) for weight,bias in zip(self.feat_weights,self.feat_biases)]
+        layers_rgb = None if density_only else [(weight[block_cell],bias[block_cell]) for weight,bias in zip(self.rgb_weights,self.rgb_biases)]
+        view_enc_blocks = to_blocks(view_enc[idx]) if view_enc is not None and not density_only else None
+        rgb_blocks,density_blocks = forward_mlps(layers_feat,layers_rgb,points_enc,view_enc_blocks) # [G,S,3],[G,S]
+        density_valid = density_blocks[block,slot]
+        if opt.nerf.density_noise_reg and mode=="train":
+            density_valid = density_valid+torch.randn_like(density_valid)*opt.nerf.density_noise_reg
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density.index_put((idx,),density_activ(density_valid))
+        if not density_only:
+            rgb = rgb.index_put((idx,),rgb_blocks[block,slot])
+        return rgb,density # [P,3],[P]
+
+    def get_cell(self,opt,points_3D): # [P,3]
+        cfg = opt.arch.kilonerf
+        range_min,range_max = cfg.range
+        coord = ((points_3D-range_min)/(range_max-range_min)*cfg.res).floor().long() # [P,3]
+        inside = ((coord>=0)&(coord<cfg.res)).all(dim=-1) # [P]
+        coord = coord.clamp(min=0,max=cfg.res-1)
+        cell = (coord[:,0]*cfg.res+coord[:,1])*cfg.res+coord[:,2] # [P]
+        return cell,inside&self.occupied[cell]
+
+    def encode(self,opt,input,L): # [B,...,3]
+        if not opt.arch.posenc: return input
+        return torch.cat([input,self.positional_encoding(opt,input,L=L)],dim=-1) # [B,...,6L+3]
+
+    @torch.no_grad()
+    def distill(self,opt,teacher):
+        # fit the MLP of each (non-empty) cell to the density/color of the teacher NeRF at random points and view directions;
+        # the teacher is queried here while the cells are trained in parallel on a process pool
+        cfg = opt.arch.kilonerf
+        range_min,range_max = cfg.range
+        cell_size = (range_max-range_min)/cfg.res
+        dims_feat,dims_rgb = get_layer_dims(opt)
+        job = edict(dims_feat=dims_feat,dims_rgb=dims_rgb,density_activ=opt.arch.density_activ,**cfg.distill)
+        teacher.eval()
+        self.occupied.zero_()
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=cfg.distill.workers,mp_context=multiprocessing.get_context("spawn"),
+                                                      initializer=torch.set_num_threads,initargs=(1,))
+        pending,loss = set(),[]
+        def collect(done):
+            for future in done:
+                c,layers_feat,layers_rgb,loss_cell = future.result()
+                for params,layers in [(self.feat_weights,layers_feat[0::2]),(self.feat_biases,layers_feat[1::2]),
+                                      (self.rgb_weights,layers_rgb[0::2]),(self.rgb_biases,layers_rgb[1::2])]:
+                    for param,value in zip(params,layers):
+                        param.data[c] = torch.from_numpy(value[0]).to(param.device)
+                self.occupied[c] = True
+                loss.append(loss_cell)
+        for c in tqdm.trange(cfg.res**3,desc="distilling",leave=False):
+            # random points in the cell
+            coord = torch.tensor([c//cfg.res**2,c//cfg.res%cfg.res,c%cfg.res],device=opt.device)
+            points_3D = range_min+(coord+torch.rand(cfg.distill.samples,3,device=opt.device))*cell_size # [N,3]
+            ray_unit = torch_F.normalize(torch.randn(cfg.distill.samples,3,device=opt.device),dim=-1) if opt.nerf.view_dep else None # [N,3]
+            rgb,density = teacher.forward(opt,points_3D,ray_unit=ray_unit,mode=None) # [N,3],[N]
+            if density.max()<cfg.distill.thres: continue # empty cell
+            inputs = [self.encode(opt,points_3D,L=opt.arch.posenc.L_3D),
+                      self.encode(opt,ray_unit,L=opt.arch.posenc.L_view) if opt.nerf.view_dep else None,rgb,density]
+            inputs = [input.cpu().numpy() if input is not None else None for input in inputs]
+            pending.add(pool.submit(distill_cell,job,c,*inputs))
+            # keep a bounded number of cells in flight
+            if len(pending)>=2*cfg.distill.workers:
+                done,pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+        collect(concurrent.futures.wait(pending).done)
+        pool.shutdown()
+        log.info("distilled {}/{} cells (mean loss: {:.4f})".format(len(loss),cfg.res**3,np.mean(loss) if loss else 0))
+
+def get_layer_dims(opt):
+    # layer dimensions of the per-cell MLPs (the last feature layer has an extra density channel)
+    cfg = opt.arch.kilonerf
+    input_3D_dim = 3+6*opt.arch.posenc.L_3D if opt.arch.posenc else 3
+    input_view_dim = 3+6*opt.arch.posenc.L_view if opt.arch.posenc else 3
+    dims_feat = util.get_layer_dims(cfg.layers_feat)
+    dims_feat[0] = (input_3D_dim,dims_feat[0][1])
+    dims_feat[-1] = (dims_feat[-1][0],dims_feat[-1][1]+1)
+    dims_rgb = util.get_layer_dims(cfg.layers_rgb)
+    dims_rgb[0] = (cfg.layers_feat[-1]+(input_view_dim if opt.nerf.view_dep else 0),dims_rgb[0][1])
+    return dims_feat,dims_rgb
+
+def init_layer(num,k_in,k_out):
+    # same initialization as torch.nn.Linear, for a stack of num layers
+    bound = 1/np.sqrt(k_in)
+    weight = torch.empty(num,k_in,k_out).uniform_(-bound,bound) # [G,K_in,K_out]
+    bias = torch.empty(num,1,k_out).uniform_(-bound,bound) # [G,1,K_out]
+    return weight,bias
+
+def forward_mlps(layers_feat,layers_rgb,points_enc,view_enc=None): # [G,S,K]
+    # batched tiny MLPs (one per group); returns the density before the activation
+    feat = points_enc
+    for li,(weight,bias) in enumerate(layers_feat):
+        feat = torch.baddbmm(bias,feat,weight)
+        if li!=len(layers_feat)-1:
+            feat = torch_F.relu(feat)
+    density = feat[...,0]
+    if layers_rgb is None: return None,density
+    feat = torch_F.relu(feat[...,1:])
+    if view_enc is not None:
+        feat = torch.cat([feat,view_enc],dim=-1)
+    for li,(weight,bias) in enumerate(layers_rgb):
+        feat = torch.baddbmm(bias,feat,weight)
+        if li!=len(layers_rgb)-1:
+            feat = torch_F.relu(feat)
+    rgb = feat.sigmoid_()
+    return rgb,density # [G,S,3],[G,S]
+
+def distill_cell(job,c,points_enc,view_enc,rgb,density):
+    # fit the MLP of cell c to the teacher outputs (runs in a worker process, numpy in/out)
+    torch.manual_seed(c)
+    points_enc,rgb,density = torch.from_numpy(points_enc),torch.from_numpy(rgb),torch.from_numpy(density)
+    view_enc = torch.from_numpy(view_enc) if view_enc is not None else None
+    layers_feat = [init_layer(1,k_in,k_out) for k_in,k_out in job.dims_feat]
+    layers_rgb = [init_layer(1,k_in,k_out) for k_in,k_out in job.dims_rgb]
+    params = [p.requires_grad_() for layer in layers_feat+layers_rgb for p in layer]
+    optim = torch.optim.Adam(params,lr=job.lr)
+    density_activ = getattr(torch_F,job.density_activ)
+    # match the density in log space (the teacher densities span orders of magnitude)
+    density_target = density.log1p()
+    for it in range(job.iters):
+        i = torch.randint(len(points_enc),(job.batch_size,))
+        rgb_pred,density_pred = forward_mlps(layers_feat,layers_rgb,points_enc[None,i],view_enc[None,i] if view_enc is not None else None)
+        loss = torch_F.mse_loss(rgb_pred[0],rgb[i])+torch_F.mse_loss(density_activ(density_pred[0]).log1p(),density_target[i])
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+    layers_feat = [p.detach().numpy() for layer in layers_feat for p in layer]
+    layers_rgb = [p.detach().numpy() for layer in layers_rgb for p in layer]
+    return c,layers_feat,layers_rgb,loss.item()
@@ -1,5 +1,7 @@
 import numpy as np
 import os,sys,time
+import json,platform,socket,functools
+import collections,concurrent.futures
 import torch
 import torch.nn.functional as torch_F
 import torchvision
@@ -15,6 +17,22 @@ from util import log,debug
 from . import base
 import camera
 import importlib
+import inspect
+import torch.utils.checkpoint
+
+# thread pool for concurrent slice/view rendering (opt.nerf.render_workers)
+render_pool = None
+# intra-op threads of the process, split among the render workers (and restored when the pool is shut down)
+render_threads = torch.get_num_threads()
+# older PyTorch versions only have the reentrant activation checkpointing
+checkpoint_reentrant_only = "use_reentrant" not in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+def shutdown_render_pool():
+    # stop the render workers and restore the intra-op threads (the workers change them for the whole process)
+    global render_pool
+    if render_pool is not None: render_pool.shutdown()
+    render_pool = None
+    torch.set_num_threads(render_threads)
 
 # ============================ main engine for training and evaluation ============================
 
@@ -30,12 +48,134 @@ class Model(base.Model):
         self.train_data.prefetch_all_data(opt)
         self.train_data.all = edict(util.move_to_device(self.train_data.all,opt.device))
 
+    def build_networks(self,opt):
+        super().build_networks(opt)
+        if opt.nerf.occupancy.enabled and opt.nerf.occupancy.depth_prior.enabled:
+            self.init_occupancy_from_depth(opt)
+        if opt.nerf.chunk_tuner.enabled:
+            self.tune_chunk_size(opt)
+
+    @torch.no_grad()
+    def tune_chunk_size(self,opt):
+        # pick the number of points per NeRF.forward call with the highest throughput under the memory budget
+        tuner = opt.nerf.chunk_tuner
+        device_name = torch.cuda.get_device_name(opt.device) if opt.device!="cpu" else "cpu{}".format(torch.get_num_threads())
+        arch = [opt.model,opt.arch.backend,opt.arch.color,opt.arch.layers_feat,opt.arch.layers_rgb,opt.arch.posenc.L_3D,opt.arch.posenc.L_view,opt.arch.density_activ]
+        key = "{}/{}/{}/{}/mem{}".format(socket.gethostname(),platform.machine(),device_name,arch,tuner.memory)
+        cache_fname = "{}/{}".format(opt.output_root,tuner.cache)
+        cache = {}
+        if os.path.isfile(cache_fname):
+            with open(cache_fname) as file: cache = json.load(file)
+        if key in cache:
+            num_points = cache[key]
+            log.info("loading tuned chunk size from {}...".format(cache_fname))
+        else:
+            log.info("tuning chunk size (memory budget: {}MB)...".format(tuner.memory))
+            nerf = self.graph.nerf
+            num_points,speed_best,memory_point = 2**tuner.log2_points[0],0,0
+            for log2_points in range(tuner.log2_points[0],tuner.log2_points[1]+1):
+                num = 2**log2_points
+                # skip candidates that would exceed the budget judging from the previous one (avoid swapping)
+                if util.get_peak_memory(opt,reset=False)+num*memory_point>tuner.memory: break
+                points_3D = torch.rand(1,num,3,device=opt.device)*2-1 # [1,N,3]
+                ray_unit = torch_F.normalize(torch.randn(1,num,3,device=opt.device),dim=-1) # [1,N,3]
+                memory_start = util.get_peak_memory(opt,reset=True)
+                time_start = time.time()
+                for _ in range(tuner.num_calls):
+                    nerf.forward(opt,points_3D,ray_unit=ray_unit,mode="eval")
+                if opt.device!="cpu": torch.cuda.synchronize()
+                speed = num*tuner.num_calls/(time.time()-time_start)
+                memory_peak = util.get_peak_memory(opt,reset=False)
+                memory_point = max(memory_peak-memory_start,0)/num
+                if memory_peak>tuner.memory: break
+                if speed>speed_best: num_points,speed_best = num,speed
+            cache[key] = num_points
+            with open(cache_fname,"w") as file: json.dump(cache,file,indent=4)
+        # the rendering chunks are in rays, each ray being one forward call of sample_intvs points (per NeRF)
+        opt.nerf.render_chunk = max(num_points//opt.nerf.sample_intvs,1)
+        if "trimesh" in opt: opt.trimesh.chunk_size = num_points
+        log.info("chunk size: {} points ({} rays)".format(num_points,opt.nerf.render_chunk))
+
+    @torch.no_grad()
+    def check_precision(self,opt):
+        # accuracy gate of reduced-precision inference: render a few test views in both precisions
+        # and fall back to fp32 if the reduced-precision renderings deviate too much from the fp32 ones
+        precision = opt.nerf.precision
+        self.graph.eval()
+        psnr,time_render = [],edict(fp32=0,reduced=0)
+        for i,batch in enumerate(self.test_loader):
+            if i>=precision.gate_views: break
+            var = edict(batch)
+            var = util.move_to_device(var,opt.device)
+            rgb = edict()
+            for name,dtype in [("fp32","fp32"),("reduced",precision.type)]:
+                opt.nerf.precision.type = dtype
+                # same stratified depth samples for both renderings
+                with torch.random.fork_rng(devices=[] if opt.device=="cpu" else [opt.device]):
+                    torch.manual_seed(opt.seed or 0)
+                    time_start = time.time()
+                    rgb[name] = self.graph.forward(opt,edict(var),mode=None).rgb # [B,HW,3]
+                    time_render[name] += time.time()-time_start
+            psnr.append(-10*self.graph.MSE_loss(rgb.reduced,rgb.fp32).log10().item())
+        psnr = np.mean(psnr)
+        log.info("{0} vs. fp32: PSNR {1:.2f}dB (min. {2}dB), speedup {3:.2f}x".format(precision.type,psnr,precision.min_psnr,time_render.fp32/time_render.reduced))
+        if psnr<precision.min_psnr:
+            log.info("{} renderings failed the accuracy gate, falling back to fp32".format(precision.type))
+            precision.type = "fp32"
+
+    def load_pretrained(self,opt):
+        # trained model and test split for the post-training tools (distillation, baking, quantization)
+        self.load_dataset(opt,eval_split="test")
+        self.build_networks(opt)
+        self.restore_checkpoint(opt)
+
+    @torch.no_grad()
+    def evaluate_test_split(self,opt):
+        # PSNR/SSIM and rendering time on the test split (with the same stratified depth samples for every call)
+        self.graph.eval()
+        res,time_render = [],0
+        for i,batch in enumerate(tqdm.tqdm(self.test_loader,desc="evaluating",leave=False)):
+            var = edict(batch)
+            var = util.move_to_device(var,opt.device)
+            with torch.random.fork_rng(devices=[] if opt.device=="cpu" else [opt.device]):
+                torch.manual_seed(i)
+                time_start = time.time()
+                var = self.graph.forward(opt,var,mode="eval")
+                if opt.device!="cpu": torch.cuda.synchronize()
+                time_render += time.time()-time_start
+            rgb_map = var.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
+            psnr = -10*self.graph.MSE_loss(rgb_map,var.image).log10().item()
+            ssim = pytorch_ssim.ssim(rgb_map,var.image).item()
+            res.append(edict(psnr=psnr,ssim=ssim))
+        return edict(psnr=np.mean([r.psnr for r in res]),ssim=np.mean([r.ssim for r in res]),time=time_render)
+
+    def init_occupancy_from_depth(self,opt):
+        # bound the occupancy grids by the sensor depth of the training views (fused once and cached next to the scene)
+        prior = opt.nerf.occupancy.depth_prior
+        range_min,range_max = opt.nerf.occupancy.range
+        cache_fname = "{0}/occupancy_prior_res{1}_range{2}_{3}_conf{4}.npy".format(self.train_data.path,opt.nerf.occupancy.res,
+                                                                                   range_min,range_max,prior.confidence)
+        if os.path.isfile(cache_fname):
+            log.info("loading depth prior from {}...".format(cache_fname))
+            cells = torch.from_numpy(np.load(cache_fname)).to(opt.device)
+        else:
+            log.info("fusing depth prior from the training views...")
+            var = self.train_data.all
+            assert("gt_depth" in var),"depth prior requires a dataset with depth maps"
+            cells = self.graph.nerf.occupancy.fuse_depth(opt,var.pose,var.intr,var.gt_depth,var.confidence)
+            np.save(cache_fname,cells.cpu().numpy())
+        self.graph.nerf.occupancy.init_from_cells(opt,cells)
+        if opt.nerf.fine_sampling:
+            self.graph.nerf_fine.occupancy.init_from_cells(opt,cells)
+        log.info("depth prior: {0}/{1} occupied cells".format(self.graph.nerf.occupancy.occupied.sum().item(),opt.nerf.occupancy.res**3))
+
     def setup_optimizer(self,opt):
         log.info("setting up optimizers...")
         optimizer = getattr(torch.optim,opt.optim.algo)
-        self.optim = optimizer([dict(params=self.graph.nerf.parameters(),lr=opt.optim.lr)])
+        self.optim = optimizer(self.graph.nerf.get_param_groups(opt))
         if opt.nerf.fine_sampling:
-            self.optim.add_param_group(dict(params=self.graph.nerf_fine.parameters(),lr=opt.optim.lr))
+            for group in self.graph.nerf_fine.get_param_groups(opt):
+                self.optim.add_param_group(group)
         # set up scheduler
         if opt.optim.sched:
             scheduler = getattr(torch.optim.lr_scheduler,opt.optim.sched.type)
@@ -69,6 +209,21 @@ class Model(base.Model):
         if opt.visdom: self.vis.close()
         log.title("TRAINING DONE")
 
+    def train_iteration(self,opt,var,loader):
+        loss = super().train_iteration(opt,var,loader)
+        # refresh the occupancy grids from the current density fields
+        if opt.nerf.occupancy.enabled and self.it%opt.nerf.occupancy.update_freq==0:
+            self.graph.nerf.occupancy.update(opt,self.graph.nerf)
+            if opt.nerf.fine_sampling:
+                self.graph.nerf_fine.occupancy.update(opt,self.graph.nerf_fine)
+        # grow the grid resolution of the grid-based backends (swapping in the resized parameters with a fresh optimizer state)
+        for nerf in [self.graph.nerf]+([self.graph.nerf_fine] if opt.nerf.fine_sampling else []):
+            for param,param_new in nerf.upsample(opt,self.it):
+                for group in self.optim.param_groups:
+                    group["params"] = [param_new if p is param else p for p in group["params"]]
+                self.optim.state.pop(param,None)
+        return loss
+
     @torch.no_grad()
     def log_scalars(self,opt,var,loss,metric=None,step=0,split="train"):
         super().log_scalars(opt,var,loss,metric=metric,step=step,split=split)
@@ -79,6 +234,10 @@ class Model(base.Model):
             if opt.nerf.fine_sampling:
                 lr = self.optim.param_groups[1]["lr"]
                 self.tb.add_scalar("{0}/{1}".format(split,"lr_fine"),lr,step)
+            # log the ratio of occupied cells
+            if opt.nerf.occupancy.enabled:
+                occupied = self.graph.nerf.occupancy.occupied.float().mean()
+                self.tb.add_scalar("{0}/{1}".format(split,"occupancy"),occupied,step)
         # compute PSNR
         psnr = -10*loss.render.log10()
         self.tb.add_scalar("{0}/{1}".format(split,"PSNR"),psnr,step)
@@ -151,6 +310,14 @@ class Model(base.Model):
     #     return pose,pose_GT
 
 
+    def log_early_stop(self,opt,skipped,num_views):
+        # report the samples saved by early ray termination
+        if opt.nerf.early_stop.enabled:
+            num_samples = opt.nerf.sample_intvs
+            if opt.nerf.fine_sampling: num_samples += opt.nerf.sample_intvs+opt.nerf.sample_intvs_fine
+            total = num_views*opt.H*opt.W*num_samples
+            log.info("early ray termination skipped {0}/{1} samples ({2:.1f}%)".format(skipped,total,100*skipped/total))
+
     @torch.no_grad()
     def evaluate_full(self,opt,eps=1e-10):
         self.graph.eval()
@@ -158,6 +325,7 @@ class Model(base.Model):
         res = []
         test_path = "{}/test_view".format(opt.output_path)
         os.makedirs(test_path,exist_ok=True)
+        skipped = 0
         for i,batch in enumerate(loader):
             var = edict(batch)
             var = util.move_to_device(var,opt.device)
@@ -165,6 +333,7 @@ class Model(base.Model):
                 # run test-time optimization to factorize imperfection in optimized poses from view synthesis evaluation
                 var = self.evaluate_test_time_photometric_optim(opt,var)
             var = self.graph.forward(opt,var,mode="eval")
+            if "skipped" in var: skipped += var.skipped.sum().item()
             # evaluate view synthesis
             invdepth = (1-var.depth)/var.opacity if opt.camera.ndc else 1/(var.depth/var.opacity+eps)
             rgb_map = var.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
@@ -193,6 +362,7 @@ class Model(base.Model):
         print("SSIM:  {:8.2f}".format(np.mean([r.ssim for r in res])))
         print("LPIPS: {:8.2f}".format(np.mean([r.lpips for r in res])))
         print("--------------------------")
+        self.log_early_stop(opt,skipped,num_views=len(res))
         # dump numbers to file
         quant_fname = "{}/quant.txt".format(opt.output_path)
         with open(quant_fname,"w") as file:
@@ -209,6 +379,7 @@ class Model(base.Model):
         res = []
         test_path = "{}/test_view".format(opt.output_path)
         os.makedirs(test_path,exist_ok=True)
+        skipped = 0
         for i,batch in enumerate(loader):
             var = edict(batch)
             var = util.move_to_device(var,opt.device)
@@ -216,6 +387,7 @@ class Model(base.Model):
                 # run test-time optimization to factorize imperfection in optimized poses from view synthesis evaluation
                 var = self.evaluate_test_time_photometric_optim(opt,var)
             var = self.graph.forward(opt,var,mode="eval")
+            if "skipped" in var: skipped += var.skipped.sum().item()
             # evaluate view synthesis
             invdepth = (1-var.depth)/var.opacity if opt.camera.ndc else 1/(var.depth/var.opacity+eps)
             rgb_map = var.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
@@ -244,6 +416,7 @@ class Model(base.Model):
         print("SSIM:  {:8.2f}".format(np.mean([r.ssim for r in res])))
         print("LPIPS: {:8.2f}".format(np.mean([r.lpips for r in res])))
         print("--------------------------")
+        self.log_early_stop(opt,skipped,num_views=len(res))
         # dump numbers to file
         quant_fname = "{}/quant.txt".format(opt.output_path)
         with open(quant_fname,"w") as file:
@@ -284,19 +457,19 @@ class Model(base.Model):
                 scale = 1
             # rotate novel views around the "center" camera of all poses
             idx_center = (poses - poses.mean(dim=0, keepdim=True))[..., 3].norm(dim=-1).argmin()
-            pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="ckpt rendering novel views", leave=False)
+            pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)[:1]
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
-                invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
-                rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
-                invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
-                # dump novel views
-                torchvision_F.to_pil_image(rgb_map.cpu()[0]).save("{}/rgb_novel_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
-                torchvision_F.to_pil_image(invdepth_map.cpu()[0]).save("{}/depth_novel_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
-                if i==0 : break
+            # dump novel views
+            skipped = 0
+            with util_vis.ImageWriter() as writer:
+                for i, ret in tqdm.tqdm(self.graph.iter_render_views(opt, pose_novel, intr=intr), total=len(pose_novel), desc="ckpt rendering novel views", leave=False):
+                    if "skipped" in ret: skipped += ret.skipped.sum().item()
+                    invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
+                    rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [1,3,H,W]
+                    invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [1,1,H,W]
+                    writer.save(rgb_map[0], "{}/rgb_novel_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
+                    writer.save(invdepth_map[0], "{}/depth_novel_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
+            self.log_early_stop(opt, skipped, num_views=len(pose_novel))
 
             """
                 ## origin novel view ##
@@ -313,21 +486,18 @@ class Model(base.Model):
                 scale = 1
             # rotate novel views around the "center" camera of all poses
             idx_center = (poses - poses.mean(dim=0, keepdim=True))[..., 3].norm(dim=-1).argmin()
-            pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="ckpt rendering origin novel views", leave=False)
+            pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)[:1]
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
-                invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
-                rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
-                invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
-
-                torchvision_F.to_pil_image(rgb_map.cpu()[0]).save(
-                    "{}/rgb_novel_origin_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
-                torchvision_F.to_pil_image(invdepth_map.cpu()[0]).save(
-                    "{}/depth_novel_origin_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
-                if i==0 : break
+            skipped = 0
+            with util_vis.ImageWriter() as writer:
+                for i, ret in tqdm.tqdm(self.graph.iter_render_views(opt, pose_novel, intr=intr), total=len(pose_novel), desc="ckpt rendering origin novel views", leave=False):
+                    if "skipped" in ret: skipped += ret.skipped.sum().item()
+                    invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
+                    rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [1,3,H,W]
+                    invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [1,1,H,W]
+                    writer.save(rgb_map[0], "{}/rgb_novel_origin_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
+                    writer.save(invdepth_map[0], "{}/depth_novel_origin_{}ckpt_{}.png".format(ckpt_image_path, ep, i))
+            self.log_early_stop(opt, skipped, num_views=len(pose_novel))
 
 
             #for test pose
@@ -400,16 +570,17 @@ class Model(base.Model):
             # render the novel views
             novel_path = "{}/novel_view".format(opt.output_path)
             os.makedirs(novel_path,exist_ok=True)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel,desc="rendering novel views",leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device) # grab intrinsics
-            for i,pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt,pose[None],intr=intr) if opt.nerf.rand_rays else \
-                      self.graph.render(opt,pose[None],intr=intr)
-                invdepth = (1-ret.depth)/ret.opacity if opt.camera.ndc else 1/(ret.depth/ret.opacity+eps)
-                rgb_map = ret.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
-                invdepth_map = invdepth.view(-1,opt.H,opt.W,1).permute(0,3,1,2) # [B,1,H,W]
-                torchvision_F.to_pil_image(rgb_map.cpu()[0]).save("{}/rgb_{}.png".format(novel_path,i))
-                torchvision_F.to_pil_image(invdepth_map.cpu()[0]).save("{}/depth_{}.png".format(novel_path,i))
+            skipped = 0
+            with util_vis.ImageWriter() as writer:
+                for i,ret in tqdm.tqdm(self.graph.iter_render_views(opt,pose_novel,intr=intr),total=len(pose_novel),desc="rendering novel views",leave=False):
+                    if "skipped" in ret: skipped += ret.skipped.sum().item()
+                    invdepth = (1-ret.depth)/ret.opacity if opt.camera.ndc else 1/(ret.depth/ret.opacity+eps)
+                    rgb_map = ret.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [1,3,H,W]
+                    invdepth_map = invdepth.view(-1,opt.H,opt.W,1).permute(0,3,1,2) # [1,1,H,W]
+                    writer.save(rgb_map[0],"{}/rgb_{}.png".format(novel_path,i))
+                    writer.save(invdepth_map[0],"{}/depth_{}.png".format(novel_path,i))
+            self.log_early_stop(opt,skipped,num_views=len(pose_novel))
             # write videos
             print("writing videos...")
             rgb_vid_fname = "{}/novel_view_rgb.mp4".format(opt.output_path)
@@ -468,16 +639,17 @@ class Model(base.Model):
             # render the novel views
             novel_path = "{}/novel_view_origin".format(opt.output_path)
             os.makedirs(novel_path, exist_ok=True)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="rendering origin novel views", leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
-                invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
-                rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
-                invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
-                torchvision_F.to_pil_image(rgb_map.cpu()[0]).save("{}/rgb_{}.png".format(novel_path, i))
-                torchvision_F.to_pil_image(invdepth_map.cpu()[0]).save("{}/depth_{}.png".format(novel_path, i))
+            skipped = 0
+            with util_vis.ImageWriter() as writer:
+                for i, ret in tqdm.tqdm(self.graph.iter_render_views(opt, pose_novel, intr=intr), total=len(pose_novel), desc="rendering origin novel views", leave=False):
+                    if "skipped" in ret: skipped += ret.skipped.sum().item()
+                    invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
+                    rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [1,3,H,W]
+                    invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [1,1,H,W]
+                    writer.save(rgb_map[0], "{}/rgb_{}.png".format(novel_path, i))
+                    writer.save(invdepth_map[0], "{}/depth_{}.png".format(novel_path, i))
+            self.log_early_stop(opt, skipped, num_views=len(pose_novel))
             # write videos
             print("writing videos...")
             rgb_vid_fname = "{}/novel_view_rgb.mp4".format(opt.output_path)
@@ -493,9 +665,22 @@ class Graph(base.Graph):
 
     def __init__(self,opt):
         super().__init__(opt)
-        self.nerf = NeRF(opt)
+        self.nerf = self.build_nerf(opt)
         if opt.nerf.fine_sampling:
-            self.nerf_fine = NeRF(opt)
+            self.nerf_fine = self.build_nerf(opt)
+
+    def build_nerf(self,opt):
+        # radiance field of the selected backend (MLP or one of the grid-based model modules)
+        if opt.arch.backend=="mlp": return NeRF(opt)
+        return importlib.import_module("model.{}".format(opt.arch.backend)).NeRF(opt)
+
+    def quantize(self,opt):
+        # swap in int8 dynamically quantized NeRFs for CPU inference (rendering is otherwise unchanged)
+        assert(opt.device=="cpu"),"dynamic int8 quantization is only supported on CPU"
+        assert(opt.nerf.precision.type=="fp32"),"int8 inference does not combine with reduced-precision autocast"
+        self.nerf = self.nerf.quantize(opt)
+        if opt.nerf.fine_sampling:
+            self.nerf_fine = self.nerf_fine.quantize(opt)
 
     def forward(self,opt,var,mode=None):
         batch_size = len(var.idx) #forward
@@ -513,9 +698,11 @@ class Graph(base.Graph):
             var.ray_idx = torch.randperm(opt.H*opt.W,device=opt.device)[:opt.nerf.rand_rays//batch_size]
             ret = self.render(opt,pose,intr=var.intr,ray_idx=var.ray_idx,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) # [B,N,3],[B,N,1]
         else:
-            # render full image (process in slices)
-            ret = self.render_by_slices(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) if opt.nerf.rand_rays else \
+            # render full image (process in slices), keeping the per-sample weights only for the depth loss
+            outputs = self.get_render_outputs(opt,weights=opt.depth.use_depth_loss and opt.loss_weight.depth>0)
+            ret = self.render_by_slices(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs) if opt.nerf.rand_rays else \
                   self.render(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,3],[B,HW,1]
+            ret = edict({k:v for k,v in ret.items() if k in outputs})
         var.update(ret)
         return var
 
@@ -524,9 +711,6 @@ class Graph(base.Graph):
         batch_size = len(var.idx)
         image = var.image.view(batch_size,3,opt.H*opt.W).permute(0,2,1) # (batch_size, opt.H*opt.W, 3) , GT?
 
-        rendering_weight = var.prob  # (batch, H*W, 128(sample point?),1)
-        z_val = var.depth_samples
-
         if opt.nerf.rand_rays and mode in ["train","test-optim"]:
             image = image[:,var.ray_idx]
 
@@ -547,6 +731,8 @@ class Graph(base.Graph):
                     pred_depth = pred_depth[:,var.ray_idx]
                 depth = depth[:,var.ray_idx]  #gt
                 confidence = confidence[:,var.ray_idx]
+            rendering_weight = var.prob  # (batch, H*W, 128(sample point?),1) or packed [S,1]
+            z_val = var.samples if "samples" in var else var.depth_samples
             loss.depth = self.compute_depth_loss(pred_depth,z_val,rendering_weight ,confidence,  depth)
         return loss
 
@@ -558,48 +744,310 @@ class Graph(base.Graph):
     def get_gt_depth(self, opt, var, mode=None):
         return var.gt_depth, var.confidence
 
-    def render(self,opt,pose,intr=None,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None):
-        batch_size = len(pose)
-        center,ray = camera.get_center_and_ray(opt,pose,intr=intr) # [B,HW,3]
-        while ray.isnan().any(): # TODO: weird bug, ray becomes NaN arbitrarily if batch_size>1, not deterministic reproducible
-            center,ray = camera.get_center_and_ray(opt,pose,intr=intr) # [B,HW,3]
-        if ray_idx is not None:
-            # consider only subset of rays
-            center,ray = center[:,ray_idx],ray[:,ray_idx]
+    def render(self,opt,pose,intr=None,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,depth_only=False):
+        # generate only the rays of the pixel subset (if given)
+        center,ray = camera.get_center_and_ray(opt,pose,intr=intr,ray_idx=ray_idx) # [B,HW,3]
         if opt.camera.ndc:
             # convert center/ray representations to NDC
             center,ray = camera.convert_NDC(opt,center,ray,intr=intr)
+        return self.render_rays(opt,center,ray,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far,depth_only=depth_only)
+
+    def render_rays(self,opt,center,ray,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,depth_only=False): # [B,HW,3]
+        # depth_only: render depth/opacity from the volume density alone (no RGB head)
+        batch_size = len(ray)
         # render with main MLP
-        depth_samples = self.sample_depth(opt,batch_size,num_rays=ray.shape[1], idx=idx,ray_idx=ray_idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,N,1] , idx : batch, ray_idx : ray num
-        rgb_samples,density_samples = self.nerf.forward_samples(opt,center,ray,depth_samples,mode=mode)
-        rgb,depth,opacity,prob = self.nerf.composite(opt,ray,rgb_samples,density_samples,depth_samples)
-        ret = edict(rgb=rgb,depth=depth,opacity=opacity,prob=prob,depth_samples=depth_samples) # [B,HW,K]
+        if opt.nerf.packed and opt.depth.use_depth and near is not None and opt.depth.budget.enabled:
+            # per-ray sample budgets from the depth confidence (generated directly in the packed layout)
+            samples = self.sample_depth_budget(opt,batch_size,num_rays=ray.shape[1],ray_idx=ray_idx,confidence=confidence,near=near,far=far)
+            depth_samples = None
+        else:
+            depth_samples = self.sample_depth(opt,batch_size,num_rays=ray.shape[1], idx=idx,ray_idx=ray_idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,N,1] , idx : batch, ray_idx : ray num
+        # inference only: stop evaluating the samples of rays that already became opaque (coarse and fine passes)
+        march = opt.nerf.early_stop.enabled and mode in [None,"eval"] and not torch.is_grad_enabled()
+        if march:
+            assert(depth_samples is not None),"early ray termination does not support the per-ray sample budgets (depth.budget)"
+            rgb,depth,opacity,prob,skipped = self.march_samples(opt,self.nerf,center,ray,depth_samples,mode=mode,depth_only=depth_only)
+            ret = edict(rgb=rgb,depth=depth,opacity=opacity,prob=prob,depth_samples=depth_samples,skipped=skipped) # [B,HW,K]
+        elif opt.nerf.packed:
+            # flatten the samples of all rays into a packed layout (dropping the ones in empty space)
+            if depth_samples is not None:
+                samples = self.pack_samples(opt,ray,depth_samples)
+            if opt.nerf.occupancy.enabled:
+                samples = self.prune_samples(opt,self.nerf,center,ray,samples)
+            rgb_samples,density_samples = self.nerf.forward_samples_packed(opt,center,ray,samples,mode=mode,depth_only=depth_only)
+            rgb,depth,opacity,prob = self.nerf.composite_packed(opt,ray,rgb_samples,density_samples,samples)
+            ret = edict(rgb=rgb,depth=depth,opacity=opacity,prob=prob,samples=samples) # [B,HW,K],[S,1]
+        else:
+            rgb_samples,density_samples = self.nerf.forward_samples(opt,center,ray,depth_samples,mode=mode,depth_only=depth_only)
+            rgb,depth,opacity,prob = self.nerf.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+            ret = edict(rgb=rgb,depth=depth,opacity=opacity,prob=prob,depth_samples=depth_samples) # [B,HW,K]
 
         # render with fine MLP from coarse MLP
         if opt.nerf.fine_sampling:
             with torch.no_grad():
+                if "samples" in ret:
+                    # scatter the packed probabilities back to the coarse sample grid
+                    prob = self.unpack_samples(opt,ray,prob,samples) # [B,HW,N,1]
+                    depth_samples = depth_samples.expand(*ray.shape[:2],-1,-1)
                 # resample depth acoording to coarse empirical distribution
                 depth_samples_fine = self.sample_depth_from_pdf(opt,pdf=prob[...,0]) # [B,HW,Nf,1]
                 depth_samples = torch.cat([depth_samples,depth_samples_fine],dim=2) # [B,HW,N+Nf,1]
                 depth_samples = depth_samples.sort(dim=2).values
-            rgb_samples,density_samples = self.nerf_fine.forward_samples(opt,center,ray,depth_samples,mode=mode)
-            rgb_fine,depth_fine,opacity_fine,prob_fine = self.nerf_fine.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+            if march:
+                rgb_fine,depth_fine,opacity_fine,prob_fine,skipped_fine = self.march_samples(opt,self.nerf_fine,center,ray,depth_samples,mode=mode,depth_only=depth_only)
+                ret.skipped = ret.skipped+skipped_fine
+            elif "samples" in ret:
+                samples_fine = self.pack_samples(opt,ray,depth_samples)
+                if opt.nerf.occupancy.enabled:
+                    samples_fine = self.prune_samples(opt,self.nerf_fine,center,ray,samples_fine)
+                rgb_samples,density_samples = self.nerf_fine.forward_samples_packed(opt,center,ray,samples_fine,mode=mode,depth_only=depth_only)
+                rgb_fine,depth_fine,opacity_fine,prob_fine = self.nerf_fine.composite_packed(opt,ray,rgb_samples,density_samples,samples_fine)
+                prob = ret.prob
+            else:
+                rgb_samples,density_samples = self.nerf_fine.forward_samples(opt,center,ray,depth_samples,mode=mode,depth_only=depth_only)
+                rgb_fine,depth_fine,opacity_fine,prob_fine = self.nerf_fine.composite(opt,ray,rgb_samples,density_samples,depth_samples)
             ret.update(rgb_fine=rgb_fine,depth_fine=depth_fine,opacity_fine=opacity_fine,prob=prob) # [B,HW,K]
+        if depth_only:
+            ret = edict({k:v for k,v in ret.items() if v is not None})
         return ret
 
-    def render_by_slices(self,opt,pose,intr=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None):
-        ret_all = edict(rgb=[],depth=[],opacity=[],prob=[],depth_samples=[])
-        if opt.nerf.fine_sampling:
-            ret_all.update(rgb_fine=[],depth_fine=[],opacity_fine=[], prob_fine = [])
-        # render the image by slices for memory considerations
-        for c in range(0,opt.H*opt.W,opt.nerf.rand_rays):
-            ray_idx = torch.arange(c,min(c+opt.nerf.rand_rays,opt.H*opt.W),device=opt.device)
-            ret = self.render(opt,pose,intr=intr,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far) # [B,R,3],[B,R,1]
-            for k in ret: ret_all[k].append(ret[k])
+    def get_render_outputs(self,opt,weights=False):
+        # per-ray outputs of full-image renderings (per-sample weights and depths are [B,HW,N,1] and only kept if asked for)
+        outputs = ["rgb","depth","opacity","rgb_fine","depth_fine","opacity_fine","skipped"]
+        if weights: outputs += ["prob","depth_samples","samples"]
+        return outputs
+
+    def iter_render_views(self,opt,pose,intr=None,mode=None,depth_only=False): # [N,3,4]
+        # render full images of N views in chunks of opt.nerf.render_chunk rays (spanning consecutive views),
+        # yielding each view as soon as all of its rays are rendered
+        num_views,num_rays = len(pose),opt.H*opt.W
+        intr = intr.expand(num_views,-1,-1) # [N,3,3]
+        chunk = opt.nerf.render_chunk or opt.nerf.rand_rays or num_rays
+        outputs = self.get_render_outputs(opt)
+        def render_chunk(c):
+            # generate the rays of the chunk view by view
+            center,ray = [],[]
+            for v in range(c//num_rays,min((c+chunk-1)//num_rays+1,num_views)):
+                ray_idx = torch.arange(max(c-v*num_rays,0),min(c+chunk-v*num_rays,num_rays),device=opt.device)
+                center_v,ray_v = camera.get_center_and_ray(opt,pose[v:v+1],intr=intr[v:v+1],ray_idx=ray_idx) # [1,R,3]
+                if opt.camera.ndc:
+                    # convert center/ray representations to NDC
+                    center_v,ray_v = camera.convert_NDC(opt,center_v,ray_v,intr=intr[v:v+1])
+                center.append(center_v)
+                ray.append(ray_v)
+            return self.render_rays(opt,torch.cat(center,dim=1),torch.cat(ray,dim=1),mode=mode,depth_only=depth_only) # [1,R,K]
+        buffer,view = edict(),0
+        for ret in self.map_render_pool(opt,render_chunk,range(0,num_views*num_rays,chunk)):
+            for k in outputs:
+                if k in ret: buffer[k] = torch.cat([buffer[k],ret[k]],dim=1) if k in buffer else ret[k]
+            # hand over the completed views
+            while view<num_views and buffer.depth.shape[1]>=num_rays:
+                yield view,edict({k:v[:,:num_rays] for k,v in buffer.items()}) # [1,HW,K]
+                buffer = edict({k:v[:,num_rays:] for k,v in buffer.items()})
+                view += 1
+
+    def render_views(self,opt,pose,intr=None,mode=None,depth_only=False): # [N,3,4]
+        ret_all = edict()
+        for _,ret in self.iter_render_views(opt,pose,intr=intr,mode=mode,depth_only=depth_only):
+            for k in ret:
+                if k not in ret_all: ret_all[k] = []
+                ret_all[k].append(ret[k])
+        for k in ret_all: ret_all[k] = torch.cat(ret_all[k],dim=0) # [N,HW,K]
+        return ret_all
+
+    def iter_render_slices(self,opt,pose,intr=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,outputs=None,depth_only=False):
+        # render the image by slices for memory considerations, yielding each slice as soon as it is rendered
+        chunk = opt.nerf.render_chunk or opt.nerf.rand_rays
+        def render_slice(c):
+            ray_idx = torch.arange(c,min(c+chunk,opt.H*opt.W),device=opt.device)
+            ret = self.render(opt,pose,intr=intr,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far,depth_only=depth_only) # [B,R,3],[B,R,1]
+            if outputs is not None:
+                # release the unused outputs of the slice right away
+                ret = edict({k:v for k,v in ret.items() if k in outputs})
+            return ray_idx,ret
+        yield from self.map_render_pool(opt,render_slice,range(0,opt.H*opt.W,chunk))
+
+    def map_render_pool(self,opt,func,inputs):
+        # evaluate func over the inputs (in order), concurrently on opt.nerf.render_workers threads if given
+        global render_pool
+        num_workers = opt.nerf.render_workers or 1
+        if render_pool is not None and render_pool._max_workers!=num_workers: shutdown_render_pool()
+        if num_workers==1:
+            for input in inputs: yield func(input)
+            return
+        if render_pool is None:
+            # split the intra-op threads among the workers
+            num_threads = max(render_threads//num_workers,1)
+            render_pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers,initializer=torch.set_num_threads,initargs=(num_threads,))
+        # the grad mode is thread-local, carry it over to the workers
+        grad_enabled = torch.is_grad_enabled()
+        def run(input):
+            with torch.set_grad_enabled(grad_enabled):
+                return func(input)
+        futures = collections.deque()
+        for input in inputs:
+            futures.append(render_pool.submit(run,input))
+            # keep at most two inputs per worker in flight
+            if len(futures)>=2*num_workers: yield futures.popleft().result()
+        while futures: yield futures.popleft().result()
+
+    def render_by_slices(self,opt,pose,intr=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,outputs=None,depth_only=False):
+        ret_all = edict()
+        for ray_idx,ret in self.iter_render_slices(opt,pose,intr=intr,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs,depth_only=depth_only):
+            if "samples" in ret:
+                # map the packed ray indices of the slice to the full image
+                ray_id = ret.samples.ray_id
+                ret.samples.ray_id = ray_id//len(ray_idx)*opt.H*opt.W+ray_idx[ray_id%len(ray_idx)]
+            for k in ret:
+                if k not in ret_all: ret_all[k] = []
+                ret_all[k].append(ret[k])
         # group all slices of images
-        for k in ret_all: ret_all[k] = torch.cat(ret_all[k],dim=1)
+        if "samples" in ret_all:
+            ret_all.samples,ret_all.prob = self.merge_packed_samples(opt,ret_all.samples,ret_all.prob,num_rays=len(pose)*opt.H*opt.W)
+        for k in ret_all:
+            if k not in ["samples","prob"] or "samples" not in ret_all:
+                ret_all[k] = torch.cat(ret_all[k],dim=1)
         return ret_all
 
+    def pack_samples(self,opt,ray,depth_samples): # [B,HW,N,1]
+        # packed layout: samples of all rays flattened into [S,...], sorted by ray, with per-ray counts/offsets
+        batch_size,num_rays = ray.shape[:2]
+        depth_samples = depth_samples.expand(batch_size,num_rays,-1,-1) # [B,HW,N,1]
+        num_samples = depth_samples.shape[2]
+        depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [B,HW,N-1]
+        depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=2) # [B,HW,N]
+        counts = torch.full((batch_size*num_rays,),num_samples,dtype=torch.long,device=ray.device) # [BR]
+        samples = edict(
+            depth=depth_samples.reshape(-1,1), # [S,1]
+            intv=depth_intv_samples.reshape(-1), # [S]
+            ray_id=torch.arange(batch_size*num_rays,device=ray.device).repeat_interleave(num_samples), # [S]
+            sample_idx=torch.arange(num_samples,device=ray.device).repeat(batch_size*num_rays), # [S]
+            counts=counts, # [BR]
+            offsets=counts.cumsum(dim=0)-counts, # [BR]
+        )
+        return samples
+
+    def prune_samples(self,opt,nerf,center,ray,samples):
+        # drop the samples inside empty cells before they reach the MLP
+        # (intervals were taken before, so the dropped samples leave the quadrature of the others unchanged)
+        center,ray = center.reshape(-1,3),ray.reshape(-1,3) # [BR,3]
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center[samples.ray_id],ray[samples.ray_id],samples.depth) # [S,3]
+        keep = nerf.occupancy.query(opt,points_3D_samples) # [S]
+        samples_kept = edict({ k:samples[k][keep] for k in ["depth","intv","ray_id","sample_idx"] })
+        samples_kept.counts = torch.bincount(samples_kept.ray_id,minlength=len(ray)) # [BR]
+        samples_kept.offsets = samples_kept.counts.cumsum(dim=0)-samples_kept.counts # [BR]
+        return samples_kept
+
+    def sample_depth_budget(self,opt,batch_size,num_rays=None,ray_idx=None,confidence=None,near=None,far=None):
+        # packed depth samples, with a per-ray budget from the depth confidence and the width of the [near,far] bound
+        assert(not opt.nerf.fine_sampling),"sample budgets are not supported with hierarchical sampling"
+        num_rays = num_rays or opt.H*opt.W
+        budget = opt.depth.budget
+        depth_min,depth_max = opt.nerf.depth.range
+        confidence,near,far = confidence.view(batch_size,-1),near.view(batch_size,-1),far.view(batch_size,-1)
+        if ray_idx is not None:
+            confidence,near,far = confidence[:,ray_idx],near[:,ray_idx],far[:,ray_idx]
+        confidence,near,far = confidence.reshape(-1).long(),near.reshape(-1).float(),far.reshape(-1).float() # [BR]
+        # confidence-0 rays : full budget over the global range
+        # confident rays : samples in [near,far] with a fixed spacing (up to the budget) + a few over the global range
+        max_band = torch.tensor(budget.samples,device=opt.device)[confidence] # [BR]
+        num_band = ((far-near)/budget.spacing).ceil().long().clamp(min=1) # [BR]
+        num_band = torch.where(confidence>0,torch.minimum(num_band,max_band),torch.zeros_like(num_band)) # [BR]
+        num_global = torch.where(confidence>0,torch.full_like(num_band,budget.global_samples),max_band) # [BR]
+        ray_id_band,depth_band = self.sample_depth_segments(opt,num_band,near,far)
+        ray_id_global,depth_global = self.sample_depth_segments(opt,num_global,torch.full_like(near,depth_min),torch.full_like(far,depth_max))
+        ray_id = torch.cat([ray_id_band,ray_id_global],dim=0) # [S]
+        depth_samples = torch.cat([depth_band,depth_global],dim=0) # [S]
+        # sort by depth, then (stably) by ray
+        order = depth_samples.argsort()
+        order = order[torch.sort(ray_id[order],stable=True).indices]
+        ray_id,depth_samples = ray_id[order],depth_samples[order]
+        depth_samples = dict(
+            metric=depth_samples,
+            inverse=1/(depth_samples+1e-8),
+        )[opt.nerf.depth.param]
+        counts = num_band+num_global # [BR]
+        offsets = counts.cumsum(dim=0)-counts # [BR]
+        depth_intv_samples = torch.cat([depth_samples[1:]-depth_samples[:-1],torch.empty_like(depth_samples[:1])],dim=0) # [S]
+        depth_intv_samples[offsets+counts-1] = 1e10
+        samples = edict(
+            depth=depth_samples[:,None], # [S,1]
+            intv=depth_intv_samples, # [S]
+            ray_id=ray_id, # [S]
+            sample_idx=torch.arange(len(ray_id),device=opt.device)-offsets[ray_id], # [S]
+            counts=counts, # [BR]
+            offsets=offsets, # [BR]
+        )
+        return samples
+
+    def sample_depth_segments(self,opt,counts,depth_low,depth_high): # [BR]
+        # (stratified) uniform samples in [depth_low,depth_high] with a different number of samples for each ray
+        ray_id = torch.arange(len(counts),device=opt.device).repeat_interleave(counts) # [S]
+        idx = torch.arange(len(ray_id),device=opt.device)-(counts.cumsum(dim=0)-counts)[ray_id] # [S]
+        rand_samples = torch.rand(len(ray_id),device=opt.device) if opt.nerf.sample_stratified else 0.5
+        rand_samples += idx.float() # [S]
+        depth_samples = rand_samples/counts[ray_id]*(depth_high-depth_low)[ray_id]+depth_low[ray_id] # [S]
+        return ray_id,depth_samples
+
+    def unpack_samples(self,opt,ray,prob,samples): # [S,1]
+        # scatter packed per-sample values back to the dense [B,HW,N,1] layout (zero for dropped samples)
+        batch_size,num_rays = ray.shape[:2]
+        prob_dense = prob.new_zeros(batch_size*num_rays,opt.nerf.sample_intvs,1) # [BR,N,1]
+        prob_dense[samples.ray_id,samples.sample_idx] = prob
+        return prob_dense.view(batch_size,num_rays,-1,1)
+
+    def merge_packed_samples(self,opt,samples_all,prob_all,num_rays):
+        # concatenate packed slices and restore the ray-major order
+        samples = edict({ k:torch.cat([s[k] for s in samples_all],dim=0) for k in ["depth","intv","ray_id","sample_idx"] })
+        prob = torch.cat(prob_all,dim=0) # [S,1]
+        order = (samples.ray_id*(samples.sample_idx.max()+1)+samples.sample_idx).argsort()
+        for k in samples: samples[k] = samples[k][order]
+        samples.counts = torch.bincount(samples.ray_id,minlength=num_rays) # [BHW]
+        samples.offsets = samples.counts.cumsum(dim=0)-samples.counts # [BHW]
+        return samples,prob[order]
+
+    @torch.no_grad()
+    def march_samples(self,opt,nerf,center,ray,depth_samples,mode=None,depth_only=False):
+        # evaluate the samples in depth-ordered chunks, compacting the rays with remaining transmittance in between
+        batch_size,num_rays = ray.shape[:2]
+        num_samples = depth_samples.shape[2]
+        center,ray = center.reshape(-1,3),ray.reshape(-1,3) # [BR,3]
+        depth_samples = depth_samples.expand(batch_size,num_rays,-1,-1).reshape(-1,num_samples,1) # [BR,N,1]
+        ray_length = ray.norm(dim=-1,keepdim=True) # [BR,1]
+        depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [BR,N-1]
+        depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=1) # [BR,N]
+        dist_samples = depth_intv_samples*ray_length # [BR,N]
+        rgb = torch.zeros(len(ray),3,device=ray.device) # [BR,3]
+        depth = torch.zeros(len(ray),1,device=ray.device) # [BR,1]
+        prob = torch.zeros(len(ray),num_samples,1,device=ray.device) # [BR,N,1]
+        T = torch.ones(len(ray),device=ray.device) # [BR]
+        evaluated = torch.zeros(len(ray),dtype=torch.long,device=ray.device) # [BR]
+        alive = torch.arange(len(ray),device=ray.device) # [A]
+        for c in range(0,num_samples,opt.nerf.early_stop.chunk):
+            if len(alive)==0: break
+            depth_chunk = depth_samples[alive,c:c+opt.nerf.early_stop.chunk] # [A,K,1]
+            rgb_chunk,density_chunk = nerf.forward_samples(opt,center[alive][None],ray[alive][None],depth_chunk[None],mode=mode,depth_only=depth_only) # [1,A,K,3],[1,A,K]
+            sigma_delta = density_chunk[0]*dist_samples[alive,c:c+opt.nerf.early_stop.chunk] # [A,K]
+            alpha = 1-(-sigma_delta).exp_() # [A,K]
+            T_chunk = T[alive,None]*(-torch.cat([torch.zeros_like(sigma_delta[...,:1]),sigma_delta[...,:-1]],dim=1).cumsum(dim=1)).exp_() # [A,K]
+            prob_chunk = (T_chunk*alpha)[...,None] # [A,K,1]
+            if not depth_only: rgb[alive] += (rgb_chunk[0]*prob_chunk).sum(dim=1)
+            depth[alive] += (depth_chunk*prob_chunk).sum(dim=1)
+            prob[alive,c:c+opt.nerf.early_stop.chunk] = prob_chunk
+            T[alive] = T_chunk[:,-1]*(1-alpha[:,-1])
+            evaluated[alive] += depth_chunk.shape[1]
+            # terminate the rays whose accumulated transmittance dropped below the threshold
+            alive = alive[T[alive]>opt.nerf.early_stop.thres]
+        opacity = prob.sum(dim=1) # [BR,1]
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        skipped = num_samples-evaluated # [BR]
+        rgb,depth,opacity = rgb.view(batch_size,num_rays,3),depth.view(batch_size,num_rays,1),opacity.view(batch_size,num_rays,1)
+        if depth_only: rgb = None
+        prob = prob.view(batch_size,num_rays,num_samples,1)
+        skipped = skipped.view(batch_size,num_rays,1)
+        return rgb,depth,opacity,prob,skipped # [B,HW,K]
+
     # def precompute_depth_sampling(self,opt,depth,confidence):
     #     #TODO : 지금 기준은 confidence , 성능 구리면 depth 값 기준으로도 더 조건 추가 4.5 이상이면 해보고 별로면
     #     depth_min, depth_max = opt.nerf.depth.range
@@ -769,52 +1217,33 @@ class Graph(base.Graph):
         # sample_intvs : sampling point num , idx : batch_num
         num_rays = num_rays or opt.H * opt.W
         depth_min,depth_max=opt.nerf.depth.range
-        rand_samples = torch.rand(batch_size, num_rays, opt.nerf.sample_intvs, 1, device=opt.device) if opt.nerf.sample_stratified else 0.5
-        rand_samples += torch.arange(opt.nerf.sample_intvs, device=opt.device)[None, None, :, None].float()  # [B,HW,N,1] [1,1024,128,1]
-        depth_samples = rand_samples / opt.nerf.sample_intvs * (depth_max - depth_min) + depth_min  # [B,HW,N,1] [1,1024,128,1]
 
         if opt.depth.use_depth and near is not None and far is not None: # [train_num,H,W] use depth info
             if opt.depth.quad_sampling:
                 N_samples_depth = opt.nerf.sample_intvs // 4
                 N_samples_origin = N_samples_depth * 3
             else :
-                N_samples_half = opt.nerf.sample_intvs // 2
                 N_samples_depth = opt.nerf.sample_intvs // 2
                 N_samples_origin = opt.nerf.sample_intvs // 2
 
-
-            # half sampling with depth infor
-            rand_samples = torch.rand(batch_size, num_rays, N_samples_depth, 1,device=opt.device) if opt.nerf.sample_stratified else 0.5
-            rand_samples += torch.arange(N_samples_depth, device=opt.device)[None, None, :,None].float()  # [B,HW,N,1] [1,1024,64,1]
-
-            near = near.view(batch_size,-1)
-            far = far.view(batch_size,-1)
-            near, far = near[:,ray_idx],far[:, ray_idx]
-            near, far = near.unsqueeze(-1), far.unsqueeze(-1)
-            near, far = near.expand_as(rand_samples[...,0]),  far.expand_as(rand_samples[...,0])  #[B,H*W,N]
-            near, far = near.unsqueeze(-1), far.unsqueeze(-1)  # [B,H*W,N,1]
-            depth_samples1 = rand_samples / N_samples_depth * (far - near) + near  # [B,HW,N,1] [1,1024,64,1]
-
-            # origin half sampling
-            rand_samples2 = torch.rand(batch_size, num_rays, N_samples_origin, 1, device=opt.device) if opt.nerf.sample_stratified else 0.5
-            rand_samples2 += torch.arange(N_samples_origin, device=opt.device)[None, None, :,None].float()  # [B,HW,N,1] [1,1024,64,1]
-            depth_samples2 = rand_samples2 / N_samples_origin * (depth_max - depth_min) + depth_min  # [B,HW,N,1] [1,1024,64,1]
-
+            near,far = near.view(batch_size,-1),far.view(batch_size,-1)
+            if ray_idx is not None:
+                near,far = near[:,ray_idx],far[:,ray_idx]
+            near,far = near[...,None,None],far[...,None,None] # [B,HW,1,1]
+            # half sampling with depth infor + origin half sampling, both sorted already
+            depth_samples1 = self.sample_depth_uniform(opt,batch_size,num_rays,N_samples_depth,near,far) # [B,HW,N,1] [1,1024,64,1]
+            depth_samples2 = self.sample_depth_uniform(opt,batch_size,num_rays,N_samples_origin,depth_min,depth_max) # [B,HW,N,1] [1,1024,64,1]
             # combination
-            depth_samples_combination = torch.cat((depth_samples1,depth_samples2),dim=2) # [1,1024,128,1]
-            depth_samples_combination, _ = torch.sort(depth_samples_combination,dim=2)
+            depth_samples = self.merge_sorted_samples(depth_samples1,depth_samples2) # [1,1024,128,1]
             if not opt.depth.sampling_half_confi0:
                 # confi0 opt.nerf.sample_intvs sampling
                 confidence = confidence.view(batch_size, -1)
-                confidence = confidence[:, ray_idx]  # [1,1024]
+                if ray_idx is not None:
+                    confidence = confidence[:, ray_idx]  # [1,1024]
                 confi0 = confidence == 0
-                depth_samples_combination[confi0] = depth_samples[confi0]
-            depth_samples = depth_samples_combination
-
-        # else:  #origin
-        #     rand_samples = torch.rand(batch_size, num_rays, opt.nerf.sample_intvs, 1, device=opt.device) if opt.nerf.sample_stratified else 0.5
-        #     rand_samples += torch.arange(opt.nerf.sample_intvs, device=opt.device)[None, None, :,None].float()  # [B,HW,N,1] [1,1024,128,1]
-        #     depth_samples = rand_samples/opt.nerf.sample_intvs * (depth_max-depth_min) + depth_min # [B,HW,N,1] [1,1024,128,1]
+                depth_samples[confi0] = self.sample_depth_uniform(opt,1,int(confi0.sum()),opt.nerf.sample_intvs,depth_min,depth_max)[0]
+        else:
+            depth_samples = self.sample_depth_uniform(opt,batch_size,num_rays,opt.nerf.sample_intvs,depth_min,depth_max) # [B,HW,N,1] [1,1024,128,1]
 
         depth_samples = dict(
             metric=depth_samples,
@@ -822,23 +1251,44 @@ class Graph(base.Graph):
         )[opt.nerf.depth.param]
         return depth_samples
 
+    def sample_depth_uniform(self,opt,batch_size,num_rays,num_samples,depth_low,depth_high):
+        # (stratified) uniform samples in [depth_low,depth_high], only broadcast to [B,HW,N,1] when needed
+        rand_samples = torch.rand(batch_size,num_rays,num_samples,1,device=opt.device) if opt.nerf.sample_stratified else 0.5
+        rand_samples += torch.arange(num_samples,device=opt.device)[None,None,:,None].float() # [B,HW,N,1] or [1,1,N,1]
+        depth_samples = rand_samples/num_samples*(depth_high-depth_low)+depth_low # [B,HW,N,1]
+        return depth_samples
+
+    def merge_sorted_samples(self,depth_samples1,depth_samples2): # [B,HW,N1,1],[B,HW,N2,1]
+        # merge two sorted sequences without sorting: each sample goes to its index plus its rank in the other sequence
+        depth_samples1,depth_samples2 = depth_samples1[...,0],depth_samples2[...,0]
+        shape = torch.broadcast_shapes(depth_samples1.shape[:-1],depth_samples2.shape[:-1])
+        depth_samples1 = depth_samples1.expand(*shape,-1).contiguous() # [B,HW,N1]
+        depth_samples2 = depth_samples2.expand(*shape,-1).contiguous() # [B,HW,N2]
+        N1,N2 = depth_samples1.shape[-1],depth_samples2.shape[-1]
+        # ties are resolved in favor of the first sequence
+        idx1 = torch.searchsorted(depth_samples2,depth_samples1).add_(torch.arange(N1,device=depth_samples1.device)) # [B,HW,N1]
+        idx2 = torch.searchsorted(depth_samples1,depth_samples2,right=True).add_(torch.arange(N2,device=depth_samples2.device)) # [B,HW,N2]
+        depth_samples = depth_samples1.new_empty(*shape,N1+N2) # [B,HW,N1+N2]
+        depth_samples.scatter_(-1,idx1,depth_samples1).scatter_(-1,idx2,depth_samples2)
+        return depth_samples[...,None] # [B,HW,N1+N2,1]
 
     def sample_depth_from_pdf(self,opt,pdf):
         depth_min,depth_max = opt.nerf.depth.range
         # get CDF from PDF (along last dimension)
         cdf = pdf.cumsum(dim=-1) # [B,HW,N]
         cdf = torch.cat([torch.zeros_like(cdf[...,:1]),cdf],dim=-1) # [B,HW,N+1]
-        # take uniform samples
+        # take uniform samples (shared by all rays)
         grid = torch.linspace(0,1,opt.nerf.sample_intvs_fine+1,device=opt.device) # [Nf+1]
-        unif = 0.5*(grid[:-1]+grid[1:]).repeat(*cdf.shape[:-1],1) # [B,HW,Nf]
-        idx = torch.searchsorted(cdf,unif,right=True) # [B,HW,Nf] \in {1...N}
-        # inverse transform sampling from CDF
+        unif = 0.5*(grid[:-1]+grid[1:]) # [Nf]
+        unif_rays = unif.expand(*cdf.shape[:-1],-1).contiguous() # [B,HW,Nf] (searchsorted needs matching leading dimensions)
+        idx = torch.searchsorted(cdf,unif_rays,right=True) # [B,HW,Nf] \in {1...N}
+        idx_low,idx_high = (idx-1).clamp_(min=0),idx.clamp_(max=opt.nerf.sample_intvs) # [B,HW,Nf]
+        # inverse transform sampling from CDF (the depth bins are indexed directly instead of repeated for every ray)
         depth_bin = torch.linspace(depth_min,depth_max,opt.nerf.sample_intvs+1,device=opt.device) # [N+1]
-        depth_bin = depth_bin.repeat(*cdf.shape[:-1],1) # [B,HW,N+1]
-        depth_low = depth_bin.gather(dim=2,index=(idx-1).clamp(min=0)) # [B,HW,Nf]
-        depth_high = depth_bin.gather(dim=2,index=idx.clamp(max=opt.nerf.sample_intvs)) # [B,HW,Nf]
-        cdf_low = cdf.gather(dim=2,index=(idx-1).clamp(min=0)) # [B,HW,Nf]
-        cdf_high = cdf.gather(dim=2,index=idx.clamp(max=opt.nerf.sample_intvs)) # [B,HW,Nf]
+        depth_low = depth_bin[idx_low] # [B,HW,Nf]
+        depth_high = depth_bin[idx_high] # [B,HW,Nf]
+        cdf_low = cdf.gather(dim=2,index=idx_low) # [B,HW,Nf]
+        cdf_high = cdf.gather(dim=2,index=idx_high) # [B,HW,Nf]
         # linear interpolation
         t = (unif-cdf_low)/(cdf_high-cdf_low+1e-8) # [B,HW,Nf]
         depth_samples = depth_low+t*(depth_high-depth_low) # [B,HW,Nf]
@@ -849,6 +1299,12 @@ class NeRF(torch.nn.Module):
     def __init__(self,opt):
         super().__init__()
         self.define_network(opt)
+        self.posenc = PositionalEncoding()
+        # frozen inference module (built on first use, kept out of the module tree and dropped when weights are loaded)
+        self.frozen = edict(module=None,progress=None)
+        self._register_load_state_dict_pre_hook(self.reset_frozen)
+        if opt.nerf.occupancy.enabled:
+            self.occupancy = OccupancyGrid(opt)
 
     def define_network(self,opt):
         input_3D_dim = 3+6*opt.arch.posenc.L_3D if opt.arch.posenc else 3
@@ -860,13 +1316,16 @@ class NeRF(torch.nn.Module):
         for li,(k_in,k_out) in enumerate(L):
             if li==0: k_in = input_3D_dim
             if li in opt.arch.skip: k_in += input_3D_dim
-            if li==len(L)-1: k_out += 1
+            if li==len(L)-1:
+                # volume density and features (or the spherical harmonics colors)
+                k_out = 1+3*self.get_num_sh(opt) if opt.arch.color=="sh" else k_out+1
             linear = torch.nn.Linear(k_in,k_out)
             if opt.arch.tf_init:
                 self.tensorflow_init_weights(opt,linear,out="first" if li==len(L)-1 else None)
             self.mlp_feat.append(linear)
         # RGB prediction
         self.mlp_rgb = torch.nn.ModuleList()
+        if opt.arch.color=="sh": return
         L = util.get_layer_dims(opt.arch.layers_rgb)
         feat_dim = opt.arch.layers_feat[-1]
         for li,(k_in,k_out) in enumerate(L):
@@ -876,6 +1335,26 @@ class NeRF(torch.nn.Module):
                 self.tensorflow_init_weights(opt,linear,out="all" if li==len(L)-1 else None)
             self.mlp_rgb.append(linear)
 
+    def get_num_sh(self,opt):
+        # spherical harmonics coefficients per color channel (only the constant one without view dependence)
+        return (opt.arch.sh_degree+1)**2 if opt.nerf.view_dep else 1
+
+    def quantize(self,opt):
+        # int8 dynamic quantization of the linear layers applied as a whole (returns a quantized copy)
+        # (the skip, output and view-dependent layers are evaluated in weight blocks and stay in fp32)
+        layers = ["mlp_feat.{}".format(li) for li in range(len(self.mlp_feat)-1) if li not in opt.arch.skip]
+        layers += ["mlp_rgb.{}".format(li) for li in range(len(self.mlp_rgb)) if li>0 or not opt.nerf.view_dep]
+        nerf = torch.quantization.quantize_dynamic(self,qconfig_spec=set(layers),dtype=torch.qint8)
+        nerf.reset_frozen()
+        return nerf
+
+    def get_param_groups(self,opt):
+        return [dict(params=self.parameters(),lr=opt.optim.lr)]
+
+    def upsample(self,opt,it):
+        # (old,new) parameter pairs when growing the resolution during training (fixed for the MLP)
+        return []
+
     def tensorflow_init_weights(self,opt,linear,out=None):
         # use Xavier init instead of Kaiming init
         relu_gain = torch.nn.init.calculate_gain("relu") # sqrt(2)
@@ -888,50 +1367,238 @@ class NeRF(torch.nn.Module):
             torch.nn.init.xavier_uniform_(linear.weight,gain=relu_gain)
         torch.nn.init.zeros_(linear.bias)
 
-    def forward(self,opt,points_3D,ray_unit=None,mode=None): # [B,...,3]
+    def forward(self,opt,points_3D,ray_unit=None,mode=None,ray_id=None): # [B,...,3]
+        # ray_unit: either broadcastable to points_3D (e.g. one direction per ray) or per ray and gathered with ray_id
+        if opt.nerf.frozen.enabled and not torch.is_grad_enabled():
+            return self.get_frozen(opt)(points_3D,ray_unit,ray_id)
+        feat,density = self.forward_geometry(opt,points_3D,mode=mode)
+        if opt.arch.color=="sh":
+            return self.get_sh_color(opt,feat,ray_unit=ray_unit,ray_id=ray_id),density
+        # predict RGB values (the view-direction encoding is computed in full precision, outside of autocast)
+        ray_enc = self.encode_view(opt,ray_unit)
+        with self.autocast(opt):
+            feat_view = self.get_view_feat(opt,feat.shape[-1],ray_enc,ray_id=ray_id)
+        num_layers = len(self.mlp_rgb)
+        segment = opt.nerf.checkpoint.segment if opt.nerf.checkpoint.enabled else num_layers
+        with self.autocast(opt):
+            for li_start in range(0,num_layers,segment):
+                layers_func = functools.partial(self.forward_rgb_layers,opt,range(li_start,min(li_start+segment,num_layers)))
+                feat = self.checkpoint(opt,layers_func,feat,feat_view) if li_start==0 and feat_view is not None else \
+                       self.checkpoint(opt,layers_func,feat)
+        rgb = feat.float().sigmoid_() # [B,...,3]
+        return rgb,density
+
+    def get_sh_color(self,opt,sh,ray_unit=None,ray_id=None): # [B,...,3(D+1)^2]
+        # closed-form view dependence of the spherical harmonics colors (the basis is evaluated once per ray)
+        sh = sh.view(*sh.shape[:-1],3,-1) # [B,...,3,(D+1)^2]
+        if not opt.nerf.view_dep:
+            return sh[...,0].sigmoid() # [B,...,3]
+        assert(ray_unit is not None)
+        basis = util.get_sh_basis(ray_unit,opt.arch.sh_degree) # [B,...,(D+1)^2]
+        if ray_id is not None: basis = basis[ray_id]
+        rgb = (sh*basis[...,None,:]).sum(dim=-1).sigmoid_() # [B,...,3]
+        return rgb
+
+    def encode_view(self,opt,ray_unit=None): # [B,...,3]
+        if not opt.nerf.view_dep: return None
+        assert(ray_unit is not None)
+        if opt.arch.posenc:
+            ray_enc = self.positional_encoding(opt,ray_unit,L=opt.arch.posenc.L_view)
+            ray_enc = torch.cat([ray_unit,ray_enc],dim=-1) # [B,...,6L+3]
+        else: ray_enc = ray_unit
+        return ray_enc
+
+    def get_view_feat(self,opt,feat_dim,ray_enc=None,ray_id=None): # [B,...,6L+3]
+        # the view-direction block of the first RGB layer is evaluated once per ray (added to the feature block)
+        if ray_enc is None: return None
+        layer = self.mlp_rgb[0]
+        feat_view = torch_F.linear(ray_enc,layer.weight[:,feat_dim:],layer.bias)
+        if ray_id is not None: feat_view = feat_view[ray_id]
+        return feat_view
+
+    def forward_rgb_layers(self,opt,layer_range,feat,feat_view=None):
+        for li in layer_range:
+            layer = self.mlp_rgb[li]
+            if li==0 and feat_view is not None:
+                feat = torch_F.linear(feat,layer.weight[:,:feat.shape[-1]])+feat_view
+            else: feat = layer(feat)
+            if li!=len(self.mlp_rgb)-1:
+                feat = torch_F.relu(feat)
+        return feat
+
+    def forward_density(self,opt,points_3D,mode=None): # [B,...,3]
+        # volume density only (skips the view encoding and the RGB head)
+        if opt.nerf.frozen.enabled and not torch.is_grad_enabled():
+            return self.get_frozen(opt).forward_density(points_3D)
+        _,density = self.forward_geometry(opt,points_3D,density_only=True,mode=mode)
+        return density
+
+    def forward_geometry(self,opt,points_3D,density_only=False,mode=None): # [B,...,3]
         if opt.arch.posenc:
             points_enc = self.positional_encoding(opt,points_3D,L=opt.arch.posenc.L_3D)
             points_enc = torch.cat([points_3D,points_enc],dim=-1) # [B,...,6L+3]
         else: points_enc = points_3D
         feat = points_enc
-        # extract coordinate-based features
-        for li,layer in enumerate(self.mlp_feat):
-            if li in opt.arch.skip: feat = torch.cat([feat,points_enc],dim=-1)
-            feat = layer(feat)
-            if li==len(self.mlp_feat)-1:
-                density = feat[...,0]
-                if opt.nerf.density_noise_reg and mode=="train":
-                    density += torch.randn_like(density)*opt.nerf.density_noise_reg
-                density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
-                density = density_activ(density)
-                feat = feat[...,1:]
-            feat = torch_F.relu(feat)
-        # predict RGB values
-        if opt.nerf.view_dep:
-            assert(ray_unit is not None)
-            if opt.arch.posenc:
-                ray_enc = self.positional_encoding(opt,ray_unit,L=opt.arch.posenc.L_view)
-                ray_enc = torch.cat([ray_unit,ray_enc],dim=-1) # [B,...,6L+3]
-            else: ray_enc = ray_unit
-            feat = torch.cat([feat,ray_enc],dim=-1)
-        for li,layer in enumerate(self.mlp_rgb):
-            feat = layer(feat)
-            if li!=len(self.mlp_rgb)-1:
-                feat = torch_F.relu(feat)
-        rgb = feat.sigmoid_() # [B,...,3]
-        return rgb,density
-
-    def forward_samples(self,opt,center,ray,depth_samples,mode=None):
+        # extract coordinate-based features (hidden layers in segments, optionally checkpointed)
+        num_layers = len(self.mlp_feat)
+        segment = opt.nerf.checkpoint.segment if opt.nerf.checkpoint.enabled else num_layers
+        with self.autocast(opt):
+            for li_start in range(0,num_layers-1,segment):
+                layers_func = functools.partial(self.forward_feat_layers,opt,range(li_start,min(li_start+segment,num_layers-1)))
+                feat = self.checkpoint(opt,layers_func,feat,points_enc)
+            # output layer: volume density and features
+            feat = self.forward_feat_layer(opt,num_layers-1,feat,points_enc,density_only=density_only)
+        density = feat[...,0].float()
+        if opt.nerf.density_noise_reg and mode=="train":
+            density += torch.randn_like(density)*opt.nerf.density_noise_reg
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density_activ(density)
+        if density_only: return None,density
+        # (the spherical harmonics colors are not rectified)
+        feat = feat[...,1:].float() if opt.arch.color=="sh" else torch_F.relu(feat[...,1:])
+        return feat,density # [B,...,K],[B,...]
+
+    def forward_feat_layers(self,opt,layer_range,feat,points_enc):
+        for li in layer_range:
+            feat = torch_F.relu(self.forward_feat_layer(opt,li,feat,points_enc))
+        return feat
+
+    def forward_feat_layer(self,opt,li,feat,points_enc,density_only=False):
+        layer = self.mlp_feat[li]
+        if li not in opt.arch.skip and not density_only: return layer(feat)
+        weight,bias = layer.weight,layer.bias
+        if density_only:
+            # only the density channel of the (last) layer is needed
+            weight,bias = weight[:1],bias[:1]
+        if li in opt.arch.skip:
+            # skip connection as a separate weight block on the input encoding (instead of concatenating it)
+            feat_dim = feat.shape[-1]
+            return torch_F.linear(feat,weight[:,:feat_dim],bias)+torch_F.linear(points_enc,weight[:,feat_dim:])
+        return torch_F.linear(feat,weight,bias)
+
+    def get_frozen(self,opt):
+        if self.frozen.module is None:
+            assert(opt.nerf.precision.type=="fp32"),"the frozen module runs in fp32"
+            frozen = FrozenNeRF(opt,self)
+            if opt.nerf.frozen.backend=="script":
+                frozen = torch.jit.script(frozen)
+            elif opt.nerf.frozen.backend=="compile":
+                assert(hasattr(torch,"compile")),"torch.compile requires PyTorch 2.0 or newer"
+                frozen = torch.compile(frozen)
+            self.frozen.module = frozen
+            self.frozen.progress = self.get_progress()
+        # the weights are shared in place, but the coarse-to-fine weights are copies of the progress at construction (BARF)
+        progress = self.get_progress()
+        if progress!=self.frozen.progress:
+            for name,weight in self.get_frozen_c2f_weights(opt).items():
+                getattr(self.frozen.module,name).copy_(weight)
+            self.frozen.progress = progress
+        return self.frozen.module
+
+    def get_progress(self):
+        return self.progress.item() if hasattr(self,"progress") else None
+
+    def get_frozen_c2f_weights(self,opt):
+        # coarse-to-fine weights of the current progress (BARF), all ones otherwise
+        L_3D = opt.arch.posenc.L_3D if opt.arch.posenc else 0
+        L_view = opt.arch.posenc.L_view if opt.arch.posenc and opt.nerf.view_dep else 0
+        weights = edict()
+        for name,L in [("weight_3D",L_3D),("weight_view",L_view)]:
+            weights[name] = self.get_c2f_weight(opt,L) if L>0 and getattr(opt,"barf_c2f",None) is not None else torch.ones(L,device=opt.device)
+        return weights
+
+    def reset_frozen(self,*args):
+        # rebuild the frozen module on next use (after loading or replacing the weights)
+        self.frozen.module = None
+
+    def autocast(self,opt):
+        # reduced-precision (bfloat16) MLP evaluation for inference only
+        # (the encodings are computed before and the outputs cast back, so the encoding/compositing stay in fp32)
+        enabled = opt.nerf.precision.type=="bf16" and not torch.is_grad_enabled()
+        return torch.autocast("cpu" if opt.device=="cpu" else "cuda",dtype=torch.bfloat16,enabled=enabled)
+
+    def checkpoint(self,opt,func,*inputs):
+        # recompute the activations of func in backward instead of keeping them (training only)
+        if not opt.nerf.checkpoint.enabled or not torch.is_grad_enabled(): return func(*inputs)
+        if checkpoint_reentrant_only:
+            # the reentrant variant gives no parameter gradients if none of its inputs requires grad
+            if not any(input.requires_grad for input in inputs): return func(*inputs)
+            return torch.utils.checkpoint.checkpoint(func,*inputs)
+        return torch.utils.checkpoint.checkpoint(func,*inputs,use_reentrant=False)
+
+    def forward_samples(self,opt,center,ray,depth_samples,mode=None,depth_only=False):
         points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,HW,N,3]
-        if opt.nerf.view_dep:
-            ray_unit = torch_F.normalize(ray,dim=-1) # [B,HW,3]
-            ray_unit_samples = ray_unit[...,None,:].expand_as(points_3D_samples) # [B,HW,N,3]
-        else: ray_unit_samples = None
+        if depth_only:
+            return None,self.forward_samples_density(opt,points_3D_samples,mode=mode) # [B,HW,N]
+        # one view direction per ray (broadcast over the samples)
+        ray_unit = torch_F.normalize(ray,dim=-1) if opt.nerf.view_dep else None # [B,HW,3]
+        if opt.nerf.occupancy.enabled:
+            # only query the MLP at samples inside occupied cells (empty space has zero density)
+            occupied = self.occupancy.query(opt,points_3D_samples) # [B,HW,N]
+            rgb_samples = points_3D_samples.new_zeros(*occupied.shape,3) # [B,HW,N,3]
+            density_samples = points_3D_samples.new_zeros(occupied.shape) # [B,HW,N]
+            if occupied.any():
+                ray_id = torch.arange(occupied.shape[0]*occupied.shape[1],device=occupied.device).view(*occupied.shape[:2],1).expand_as(occupied)[occupied] # [M]
+                ray_unit_flat = ray_unit.reshape(-1,3) if opt.nerf.view_dep else None # [BHW,3]
+                rgb_occupied,density_occupied = self.forward(opt,points_3D_samples[occupied],ray_unit=ray_unit_flat,mode=mode,ray_id=ray_id) # [M,3],[M]
+                rgb_samples[occupied],density_samples[occupied] = rgb_occupied,density_occupied
+            return rgb_samples,density_samples
+        ray_unit_samples = ray_unit[...,None,:] if opt.nerf.view_dep else None # [B,HW,1,3]
         rgb_samples,density_samples = self.forward(opt,points_3D_samples,ray_unit=ray_unit_samples,mode=mode) # [B,HW,N],[B,HW,N,3]
         return rgb_samples,density_samples
 
+    def forward_samples_density(self,opt,points_3D_samples,mode=None): # [B,HW,N,3]
+        if opt.nerf.occupancy.enabled:
+            occupied = self.occupancy.query(opt,points_3D_samples) # [B,HW,N]
+            density_samples = points_3D_samples.new_zeros(occupied.shape) # [B,HW,N]
+            if occupied.any():
+                density_samples[occupied] = self.forward_density(opt,points_3D_samples[occupied],mode=mode) # [M]
+            return density_samples
+        return self.forward_density(opt,points_3D_samples,mode=mode) # [B,HW,N]
+
+    def forward_samples_packed(self,opt,center,ray,samples,mode=None,depth_only=False):
+        center,ray = center.reshape(-1,3),ray.reshape(-1,3) # [BR,3]
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center[samples.ray_id],ray[samples.ray_id],samples.depth) # [S,3]
+        if depth_only:
+            return None,self.forward_density(opt,points_3D_samples,mode=mode) # [S]
+        ray_unit = torch_F.normalize(ray,dim=-1) if opt.nerf.view_dep else None # [BR,3]
+        rgb_samples,density_samples = self.forward(opt,points_3D_samples,ray_unit=ray_unit,mode=mode,ray_id=samples.ray_id) # [S,3],[S]
+        return rgb_samples,density_samples
+
+    def composite_packed(self,opt,ray,rgb_samples,density_samples,samples):
+        batch_size,num_rays = ray.shape[:2]
+        ray_length = ray.reshape(-1,3).norm(dim=-1) # [BR]
+        # volume rendering: compute probability (using quadrature)
+        dist_samples = samples.intv*ray_length[samples.ray_id] # [S]
+        sigma_delta = density_samples*dist_samples # [S]
+        alpha = 1-(-sigma_delta).exp_() # [S]
+        # exclusive segment-wise cumsum, in double precision as it runs across all rays
+        # (the last sample of a ray, with its 1e10 interval, never contributes to its own ray and is left out)
+        last = (samples.offsets+samples.counts-1)[samples.counts>0] # [BR']
+        sigma_delta_excl = sigma_delta.double().index_fill(0,last,0) # [S]
+        sigma_delta_cum = sigma_delta_excl.cumsum(dim=0)-sigma_delta_excl # [S]
+        sigma_delta_cum = sigma_delta_cum-sigma_delta_cum[samples.offsets[samples.ray_id]] # [S]
+        T = (-sigma_delta_cum.float()).exp_() # [S]
+        prob = (T*alpha)[...,None] # [S,1]
+        # integrate RGB and depth weighted by probability (segment-wise sum)
+        depth = prob.new_zeros(batch_size*num_rays,1).index_add(0,samples.ray_id,samples.depth*prob) # [BR,1]
+        opacity = prob.new_zeros(batch_size*num_rays,1).index_add(0,samples.ray_id,prob) # [BR,1]
+        depth,opacity = depth.view(batch_size,num_rays,1),opacity.view(batch_size,num_rays,1)
+        if rgb_samples is None: return None,depth,opacity,prob # depth-only rendering
+        rgb = prob.new_zeros(batch_size*num_rays,3).index_add(0,samples.ray_id,rgb_samples*prob) # [BR,3]
+        rgb = rgb.view(batch_size,num_rays,3)
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        return rgb,depth,opacity,prob # [B,HW,K],[S,1]
+
     def composite(self,opt,ray,rgb_samples,density_samples,depth_samples):
         ray_length = ray.norm(dim=-1,keepdim=True) # [B,HW,1]
+        if opt.nerf.fused_composite and rgb_samples is not None and not depth_samples.requires_grad:
+            # single autograd function that recomputes the per-sample intermediates in backward
+            rgb,depth,opacity,prob = Composite.apply(rgb_samples,density_samples,depth_samples,ray_length)
+            if opt.nerf.setbg_opaque:
+                rgb = rgb+opt.data.bgcolor*(1-opacity)
+            return rgb,depth,opacity,prob # [B,HW,K]
         # volume rendering: compute probability (using quadrature)
         depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [B,HW,N-1]
         depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=2) # [B,HW,N]
@@ -942,17 +1609,310 @@ class NeRF(torch.nn.Module):
         prob = (T*alpha)[...,None] # [B,HW,N,1]
         # integrate RGB and depth weighted by probability
         depth = (depth_samples*prob).sum(dim=2) # [B,HW,1]
-        rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
         opacity = prob.sum(dim=2) # [B,HW,1]
+        if rgb_samples is None: return None,depth,opacity,prob # depth-only rendering
+        rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
         if opt.nerf.setbg_opaque:
             rgb = rgb+opt.data.bgcolor*(1-opacity)
         return rgb,depth,opacity,prob # [B,HW,K]
 
     def positional_encoding(self,opt,input,L): # [B,...,N]
+        input_enc = self.posenc(input,L) # [B,...,2NL]
+        return input_enc
+
+class FrozenNeRF(torch.nn.Module):
+    # inference-only NeRF with all options resolved at construction (for TorchScript/torch.compile),
+    # evaluating the weights of a trained NeRF in place (as views, without copying them)
+
+    def __init__(self,opt,nerf):
+        super().__init__()
+        assert(isinstance(nerf.mlp_feat[0],torch.nn.Linear)),"the frozen module requires the fp32 (non-quantized) layers"
+        assert(opt.arch.density_activ in ["softplus","relu","abs","sigmoid","exp"])
+        self.view_dep = opt.nerf.view_dep
+        self.density_activ = opt.arch.density_activ
+        self.L_3D = opt.arch.posenc.L_3D if opt.arch.posenc else 0
+        self.L_view = opt.arch.posenc.L_view if opt.arch.posenc and opt.nerf.view_dep else 0
+        # coarse-to-fine weights (refreshed in place by the trained NeRF as its progress changes)
+        for name,weight in nerf.get_frozen_c2f_weights(opt).items():
+            self.register_buffer(name,weight,persistent=False)
+        # point-wise feature (skip connections as separate weight blocks on the input encoding)
+        input_3D_dim = 3+6*self.L_3D if opt.arch.posenc else 3
+        layers = []
+        for li,layer in enumerate(nerf.mlp_feat):
+            feat_dim = layer.in_features-input_3D_dim if li in opt.arch.skip else layer.in_features
+            layers.append(FrozenLinear(layer.weight[:,:feat_dim],layer.bias,layer.weight[:,feat_dim:] if li in opt.arch.skip else None))
+        self.mlp_feat = torch.nn.ModuleList(layers[:-1])
+        self.feat_out = layers[-1]
+        # volume density only (first row of the output layer)
+        weight_skip = self.feat_out.weight_skip
+        self.density_out = FrozenLinear(self.feat_out.weight[:1],self.feat_out.bias[:1],weight_skip[:1] if weight_skip is not None else None)
+        # RGB prediction (view-direction block of the first layer evaluated per ray), or spherical harmonics colors
+        self.color_sh = opt.arch.color=="sh"
+        self.sh_degree = opt.arch.sh_degree
+        self.rgb_in,self.view_in = None,None
+        self.mlp_rgb = torch.nn.ModuleList()
+        if not self.color_sh:
+            feat_dim = opt.arch.layers_feat[-1]
+            layer = nerf.mlp_rgb[0]
+            self.rgb_in = FrozenLinear(layer.weight[:,:feat_dim],None if self.view_dep else layer.bias)
+            self.view_in = FrozenLinear(layer.weight[:,feat_dim:],layer.bias) if self.view_dep else None
+            self.mlp_rgb = torch.nn.ModuleList([FrozenLinear(layer.weight,layer.bias) for layer in nerf.mlp_rgb[1:]])
+
+    def forward(self,points_3D,ray_unit=None,ray_id=None): # [B,...,3]
+        # type: (Tensor,Optional[Tensor],Optional[Tensor]) -> Tuple[Tensor,Tensor]
+        feat,density = self.forward_geometry(points_3D)
+        rgb_in = self.rgb_in
+        if rgb_in is None:
+            return self.get_sh_color(feat,ray_unit,ray_id),density
+        feat = rgb_in(feat,None)
+        view_in = self.view_in
+        if view_in is not None and ray_unit is not None:
+            # view-direction block of the first layer (once per ray)
+            ray_enc = self.encode(ray_unit,self.L_view,self.weight_view) # [B,...,6L+3]
+            feat_view = view_in(ray_enc,None)
+            if ray_id is not None: feat_view = feat_view[ray_id]
+            feat = feat+feat_view
+        for layer in self.mlp_rgb:
+            feat = layer(torch_F.relu(feat),None)
+        rgb = feat.sigmoid_() # [B,...,3]
+        return rgb,density
+
+    @torch.jit.export
+    def forward_density(self,points_3D): # [B,...,3]
+        points_enc = self.encode(points_3D,self.L_3D,self.weight_3D) # [B,...,6L+3]
+        feat = self.forward_hidden(points_enc)
+        density = self.density_out(feat,points_enc)[...,0]
+        return self.activate_density(density) # [B,...]
+
+    def forward_geometry(self,points_3D): # [B,...,3]
+        points_enc = self.encode(points_3D,self.L_3D,self.weight_3D) # [B,...,6L+3]
+        feat = self.feat_out(self.forward_hidden(points_enc),points_enc)
+        density = self.activate_density(feat[...,0])
+        feat = feat[...,1:] if self.color_sh else torch_F.relu(feat[...,1:])
+        return feat,density # [B,...,K],[B,...]
+
+    def get_sh_color(self,sh,ray_unit=None,ray_id=None): # [B,...,3(D+1)^2]
+        # type: (Tensor,Optional[Tensor],Optional[Tensor]) -> Tensor
+        sh = sh.view(list(sh.shape[:-1])+[3,-1]) # [B,...,3,(D+1)^2]
+        if not self.view_dep or ray_unit is None:
+            return sh[...,0].sigmoid() # [B,...,3]
+        basis = util.get_sh_basis(ray_unit,self.sh_degree) # [B,...,(D+1)^2]
+        if ray_id is not None: basis = basis[ray_id]
+        rgb = (sh*basis.unsqueeze(-2)).sum(dim=-1).sigmoid() # [B,...,3]
+        return rgb
+
+    def forward_hidden(self,points_enc):
+        feat = points_enc
+        for layer in self.mlp_feat:
+            feat = torch_F.relu(layer(feat,points_enc))
+        return feat
+
+    def activate_density(self,density):
+        if self.density_activ=="softplus": return torch_F.softplus(density)
+        if self.density_activ=="relu": return torch_F.relu(density)
+        if self.density_activ=="abs": return density.abs()
+        if self.density_activ=="sigmoid": return density.sigmoid()
+        return density.exp()
+
+    def encode(self,input,L,weight): # [B,...,3]
+        # type: (Tensor,int,Tensor) -> Tensor
+        if L==0: return input
+        # angle-doubling recurrence (as in PositionalEncoding)
+        angle = input*np.pi
+        sin,cos = [angle.sin()],[angle.cos()]
+        for k in range(1,L):
+            sin.append(2*sin[k-1]*cos[k-1])
+            cos.append((cos[k-1]-sin[k-1])*(cos[k-1]+sin[k-1]))
+        input_enc = torch.stack([torch.stack(sin,dim=-1),torch.stack(cos,dim=-1)],dim=-2)*weight # [B,...,3,2,L]
+        return torch.cat([input,input_enc.flatten(start_dim=-3)],dim=-1) # [B,...,6L+3]
+
+class FrozenLinear(torch.nn.Module):
+    # linear layer on views of trained weight blocks (weight_skip: optional block on a second input)
+
+    def __init__(self,weight,bias,weight_skip=None):
+        super().__init__()
+        self.register_buffer("weight",weight.detach(),persistent=False)
+        self.register_buffer("bias",bias.detach() if bias is not None else None,persistent=False)
+        self.register_buffer("weight_skip",weight_skip.detach() if weight_skip is not None else None,persistent=False)
+
+    def forward(self,feat,input):
+        # type: (Tensor,Optional[Tensor]) -> Tensor
+        output = torch_F.linear(feat,self.weight,self.bias)
+        weight_skip = self.weight_skip
+        if weight_skip is not None and input is not None:
+            output = output+torch_F.linear(input,weight_skip)
+        return output
+
+class Composite(torch.autograd.Function):
+    # volume rendering of the (dense) ray samples, saving only the inputs for backward
+
+    @staticmethod
+    def volume(density_samples,depth_samples,ray_length): # [B,HW,N],[B,HW,N,1],[B,HW,1]
+        depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [B,HW,N-1]
+        depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=2) # [B,HW,N]
+        sigma_delta = density_samples*depth_intv_samples*ray_length # [B,HW,N]
+        transmit = (-sigma_delta).exp() # [B,HW,N]
+        T = (-torch.cat([torch.zeros_like(sigma_delta[...,:1]),sigma_delta[...,:-1]],dim=2).cumsum(dim=2)).exp_() # [B,HW,N]
+        return depth_intv_samples,transmit,T
+
+    @staticmethod
+    def forward(ctx,rgb_samples,density_samples,depth_samples,ray_length): # [B,HW,N,3],[B,HW,N],[B,HW,N,1],[B,HW,1]
+        _,transmit,T = Composite.volume(density_samples,depth_samples,ray_length)
+        prob = (T*(1-transmit))[...,None] # [B,HW,N,1]
+        rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
+        depth = (depth_samples*prob).sum(dim=2) # [B,HW,1]
+        opacity = prob.sum(dim=2) # [B,HW,1]
+        ctx.save_for_backward(rgb_samples,density_samples,depth_samples,ray_length)
+        ctx.set_materialize_grads(False)
+        return rgb,depth,opacity,prob # [B,HW,K]
+
+    @staticmethod
+    def backward(ctx,grad_rgb,grad_depth,grad_opacity,grad_prob):
+        rgb_samples,density_samples,depth_samples,ray_length = ctx.saved_tensors
+        depth_intv_samples,transmit,T = Composite.volume(density_samples,depth_samples,ray_length)
+        prob = T*(1-transmit) # [B,HW,N]
+        # gradient w.r.t. the weights, from all outputs that received one
+        grad_w = torch.zeros_like(prob) # [B,HW,N]
+        if grad_rgb is not None: grad_w += (rgb_samples*grad_rgb[...,None,:]).sum(dim=-1)
+        if grad_depth is not None: grad_w += depth_samples[...,0]*grad_depth
+        if grad_opacity is not None: grad_w += grad_opacity
+        if grad_prob is not None: grad_w += grad_prob[...,0]
+        # prob_i = T_i-T_{i+1} with T_{i+1} = T_i*exp(-sigma_delta_i), hence
+        # d(loss)/d(sigma_delta_k) = T_{k+1}*grad_w_k - sum_{i>k} grad_w_i*prob_i
+        grad_w_prob = (grad_w*prob).flip(dims=[2]).cumsum(dim=2).flip(dims=[2]) # [B,HW,N]
+        grad_w_prob = torch.cat([grad_w_prob[...,1:],torch.zeros_like(grad_w_prob[...,:1])],dim=2) # [B,HW,N]
+        grad_sigma_delta = T*transmit*grad_w-grad_w_prob # [B,HW,N]
+        grad_rgb_samples = grad_density_samples = grad_ray_length = None
+        if ctx.needs_input_grad[0] and grad_rgb is not None:
+            grad_rgb_samples = prob[...,None]*grad_rgb[...,None,:] # [B,HW,N,3]
+        if ctx.needs_input_grad[1]:
+            grad_density_samples = grad_sigma_delta*depth_intv_samples*ray_length # [B,HW,N]
+        if ctx.needs_input_grad[3]:
+            grad_ray_length = (grad_sigma_delta*density_samples*depth_intv_samples).sum(dim=2,keepdim=True) # [B,HW,1]
+        return grad_rgb_samples,grad_density_samples,None,grad_ray_length
+
+class PositionalEncoding(torch.nn.Module):
+    # [sin(2^k*pi*x),cos(2^k*pi*x)] for L octaves, from a single sin/cos evaluation and the angle-doubling recurrence
+    # (optionally weighted per octave, with the octave weights cached per key)
+
+    def __init__(self):
+        super().__init__()
+        self.weight_cache = {}
+
+    def get_weight(self,L,key,func):
+        # recompute the octave weights only when the key changes (e.g. the BARF coarse-to-fine progress)
+        if L not in self.weight_cache or self.weight_cache[L][0]!=key:
+            self.weight_cache[L] = (key,func())
+        return self.weight_cache[L][1]
+
+    def forward(self,input,L,weight=None): # [B,...,N]
         shape = input.shape
-        freq = 2**torch.arange(L,dtype=torch.float32,device=opt.device)*np.pi # [L]
-        spectrum = input[...,None]*freq # [B,...,N,L]
-        sin,cos = spectrum.sin(),spectrum.cos() # [B,...,N,L]
-        input_enc = torch.stack([sin,cos],dim=-2) # [B,...,N,2,L]
+        angle = input*np.pi
+        # sin(2a) = 2*sin(a)*cos(a), cos(2a) = (cos(a)-sin(a))*(cos(a)+sin(a))
+        if torch.is_grad_enabled() and input.requires_grad:
+            sin,cos = [angle.sin()],[angle.cos()] # [B,...,N]
+            for k in range(1,L):
+                sin.append(2*sin[-1]*cos[-1])
+                cos.append((cos[-1]-sin[-2])*(cos[-1]+sin[-2]))
+            input_enc = torch.stack([torch.stack(sin,dim=-1),torch.stack(cos,dim=-1)],dim=-2) # [B,...,N,2,L]
+            if weight is not None: input_enc = input_enc*weight
+        else:
+            # without autograd, run the recurrence in place in an octave-major buffer
+            enc = input.new_empty(2,L,*shape) # [2,L,B,...,N]
+            torch.sin(angle,out=enc[0,0])
+            torch.cos(angle,out=enc[1,0])
+            for k in range(1,L):
+                sin,cos = enc[0,k-1],enc[1,k-1]
+                torch.mul(sin,cos,out=enc[0,k]).mul_(2)
+                torch.mul(cos-sin,cos+sin,out=enc[1,k])
+            enc = enc.permute(*range(2,len(shape)+2),0,1) # [B,...,N,2,L]
+            # reorder (and weight) in a single pass
+            input_enc = input.new_empty(*shape,2,L) # [B,...,N,2,L]
+            if weight is not None: torch.mul(enc,weight,out=input_enc)
+            else: input_enc.copy_(enc)
         input_enc = input_enc.view(*shape[:-1],-1) # [B,...,2NL]
         return input_enc
+
+class OccupancyGrid(torch.nn.Module):
+    """
+    binary occupancy grid over a cubic 3D range, maintained from the density output of the NeRF
+    cells that were never evaluated (cached density < 0) are treated as occupied
+    cells outside the (optional) depth prior are never occupied
+    """
+
+    def __init__(self,opt):
+        super().__init__()
+        res = opt.nerf.occupancy.res
+        self.register_buffer("density",torch.full((res,res,res),-1.)) # cached (decayed) max density per cell
+        self.register_buffer("occupied",torch.ones(res,res,res,dtype=torch.bool))
+        self.register_buffer("prior",torch.ones(res,res,res,dtype=torch.bool)) # cells allowed to be occupied
+
+    def get_grid_index(self,opt,points_3D): # [...,3]
+        range_min,range_max = opt.nerf.occupancy.range
+        grid_idx = ((points_3D-range_min)/(range_max-range_min)*opt.nerf.occupancy.res).floor().long() # [...,3]
+        return grid_idx
+
+    @torch.no_grad()
+    def query(self,opt,points_3D): # [...,3]
+        res = opt.nerf.occupancy.res
+        grid_idx = self.get_grid_index(opt,points_3D) # [...,3]
+        inside = ((grid_idx>=0)&(grid_idx<res)).all(dim=-1) # [...]
+        grid_idx = grid_idx.clamp_(min=0,max=res-1)
+        occupied = self.occupied[grid_idx[...,0],grid_idx[...,1],grid_idx[...,2]] # [...]
+        # points outside the grid are always considered occupied
+        return occupied|~inside
+
+    @torch.no_grad()
+    def update(self,opt,nerf):
+        res = opt.nerf.occupancy.res
+        range_min,range_max = opt.nerf.occupancy.range
+        density_grid = self.density.view(-1) # [res^3]
+        # decay the cached densities so that cells can turn empty again
+        visited = density_grid>=0
+        density_grid[visited] *= opt.nerf.occupancy.decay
+        # evaluate the density at a random position within a random subset of cells
+        cell_idx = torch.randperm(res**3,device=opt.device)[:opt.nerf.occupancy.update_cells] # [M]
+        grid_idx = torch.stack([cell_idx//res**2,cell_idx//res%res,cell_idx%res],dim=-1) # [M,3]
+        points_3D = (grid_idx+torch.rand(grid_idx.shape,device=opt.device))/res*(range_max-range_min)+range_min # [M,3]
+        density = nerf.forward_density(opt,points_3D[None]) # [1,M]
+        density_grid[cell_idx] = torch.maximum(density_grid[cell_idx],density[0])
+        # threshold the cached densities (relative to the mean for sparse scenes)
+        visited = density_grid>=0
+        thres = min(opt.nerf.occupancy.thres,density_grid[visited].mean().item())
+        self.occupied.copy_(((self.density>thres)|(self.density<0))&self.prior)
+
+    @torch.no_grad()
+    def fuse_depth(self,opt,pose,intr,depth,confidence): # [N,3,4],[N,3,3],[N,H,W],[N,H,W]
+        # back-project the confident depth pixels of all views and collect the (linear) indices of the cells they hit
+        res = opt.nerf.occupancy.res
+        H,W = depth.shape[-2:]
+        y_range = torch.arange(H,dtype=torch.float32,device=depth.device).add_(0.5)
+        x_range = torch.arange(W,dtype=torch.float32,device=depth.device).add_(0.5)
+        Y,X = torch.meshgrid(y_range,x_range) # [H,W]
+        xy_grid = torch.stack([X,Y],dim=-1).view(-1,2) # [HW,2]
+        cells = []
+        for p,K,d,c in zip(pose,intr,depth.view(len(depth),-1),confidence.view(len(confidence),-1)):
+            valid = (c>=opt.nerf.occupancy.depth_prior.confidence)&(d>0) # [HW]
+            # intrinsics are given at the image resolution, rescale them to the depth maps
+            K = K.clone()
+            K[0] *= W/opt.W
+            K[1] *= H/opt.H
+            points_cam = camera.img2cam(camera.to_hom(xy_grid[valid]),K)*d[valid,None] # [M,3]
+            points_3D = camera.cam2world(points_cam[None],p[None])[0] # [M,3]
+            grid_idx = self.get_grid_index(opt,points_3D) # [M,3]
+            grid_idx = grid_idx[((grid_idx>=0)&(grid_idx<res)).all(dim=-1)]
+            cells.append((grid_idx[:,0]*res+grid_idx[:,1])*res+grid_idx[:,2])
+            cells = [torch.cat(cells).unique()]
+        return cells[0] # [M]
+
+    @torch.no_grad()
+    def init_from_cells(self,opt,cells): # [M]
+        # restrict the grid to the (dilated) prior cells, which stay unvisited until evaluated by the NeRF
+        res = opt.nerf.occupancy.res
+        prior = torch.zeros(res**3,device=cells.device)
+        prior[cells] = 1
+        r = opt.nerf.occupancy.depth_prior.dilate
+        prior = torch_F.max_pool3d(prior.view(1,1,res,res,res),kernel_size=2*r+1,stride=1,padding=r)[0,0] # [res,res,res]
+        self.prior.copy_(prior>0)
+        self.density.fill_(-1)
+        self.occupied.copy_(self.prior)
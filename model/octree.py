@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+import torch.nn.functional as torch_F
+import tqdm
+
+import util
+from util import log,debug
+from . import nerf
+
+# ============================ sparse voxel octree baked from a trained NeRF ============================
+
+class NeRF(nerf.NeRF):
+    # sparse voxel octree (PlenOctrees) with a volume density and spherical harmonics color coefficients per leaf
+    # (opt.arch.backend=octree), with the same forward contract as the MLP NeRF but no MLP: points are looked up
+    # by descending the tree and the view dependence is evaluated in closed form; the leaves are filled with bake()
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.progress = torch.nn.Parameter(torch.tensor(0.)) # use Parameter so it could be checkpointed (BARF)
+        # the tree size is only known after baking, resize the buffers before loading
+        self._register_load_state_dict_pre_hook(self.resize_to_state_dict)
+
+    def define_network(self,opt):
+        num_coeffs = (opt.arch.octree.sh_degree+1)**2 if opt.nerf.view_dep else 1
+        # child of each octant of the nodes (a node at the next level, or a leaf at the last level), -1 if empty
+        self.register_buffer("nodes",torch.full((1,8),-1,dtype=torch.long)) # [N,8]
+        # leaf 0 is the empty space (zero density)
+        self.register_buffer("density",torch.zeros(1)) # [M+1]
+        self.register_buffer("sh",torch.zeros(1,3,num_coeffs)) # [M+1,3,(D+1)^2] (colors before the sigmoid)
+
+    def forward(self,opt,points_3D,ray_unit=None,mode=None,ray_id=None): # [B,...,3]
+        # ray_unit: either broadcastable to points_3D (e.g. one direction per ray) or per ray and gathered with ray_id
+        leaf = self.get_leaf(opt,points_3D.reshape(-1,3)).view(points_3D.shape[:-1]) # [B,...]
+        density = self.density[leaf] # [B,...]
+        if opt.nerf.view_dep:
+            assert(ray_unit is not None)
+            # the basis is evaluated once per ray
+            basis = util.get_sh_basis(ray_unit,opt.arch.octree.sh_degree) # [B,...,(D+1)^2]
+            if ray_id is not None: basis = basis[ray_id]
+            rgb = (self.sh[leaf]*basis[...,None,:]).sum(dim=-1) # [B,...,3]
+        else: rgb = self.sh[leaf][...,0]
+        rgb = rgb.sigmoid_() # [B,...,3]
+        return rgb,density
+
+    def forward_density(self,opt,points_3D,mode=None): # [B,...,3]
+        leaf = self.get_leaf(opt,points_3D.reshape(-1,3)).view(points_3D.shape[:-1]) # [B,...]
+        return self.density[leaf] # [B,...]
+
+    def get_leaf(self,opt,points_3D): # [P,3]
+        # descend the tree along the octants containing the points (leaf 0 for empty space and outside of the range)
+        cfg = opt.arch.octree
+        res = 2**cfg.depth
+        range_min,range_max = cfg.range
+        coord = ((points_3D-range_min)/(range_max-range_min)*res).floor().long() # [P,3]
+        inside = ((coord>=0)&(coord<res)).all(dim=-1) # [P]
+        coord = coord.clamp(min=0,max=res-1)
+        node = inside.long()-1 # [P] (root node or empty)
+        for level in range(cfg.depth):
+            bit = (coord>>(cfg.depth-1-level))&1 # [P,3]
+            octant = bit[:,0]*4+bit[:,1]*2+bit[:,2] # [P]
+            node = torch.where(node>=0,self.nodes[node.clamp(min=0),octant],node)
+        return node.clamp(min=0) # [P]
+
+    def resize_to_state_dict(self,state_dict,prefix,*args):
+        for name,buffer in self.named_buffers(recurse=False):
+            key = prefix+name
+            if key in state_dict and state_dict[key].shape!=buffer.shape:
+                setattr(self,name,buffer.new_empty(state_dict[key].shape))
+
+    @torch.no_grad()
+    def bake(self,opt,teacher):
+        # evaluate the teacher density on the dense leaf grid (one slab at a time) and keep the occupied leaves,
+        # with their mean density at random points and the spherical harmonics projection of their colors
+        cfg = opt.arch.octree
+        res = 2**cfg.depth
+        range_min,range_max = cfg.range
+        cell_size = (range_max-range_min)/res
+        teacher.eval()
+        # directions for the color projection (Fibonacci sphere) and the least-squares projection matrix
+        i = torch.arange(cfg.bake.directions,dtype=torch.float32,device=opt.device)+0.5
+        z = 1-2*i/cfg.bake.directions
+        phi = np.pi*(1+np.sqrt(5))*i
+        dirs = torch.stack([(1-z**2).sqrt()*phi.cos(),(1-z**2).sqrt()*phi.sin(),z],dim=-1) # [K,3]
+        project = torch.linalg.pinv(util.get_sh_basis(dirs,cfg.sh_degree)) # [(D+1)^2,K]
+        grid = torch.stack(torch.meshgrid(torch.arange(res,device=opt.device),torch.arange(res,device=opt.device)),dim=-1).view(-1,2) # [R^2,2]
+        chunk_leaves = max(cfg.bake.chunk_size//max(cfg.bake.samples,cfg.bake.directions),1)
+        coords,density,sh = [],[self.density.new_zeros(1)],[self.sh.new_zeros(1,*self.sh.shape[1:])]
+        for x in tqdm.trange(res,desc="baking",leave=False):
+            coord = torch.cat([torch.full_like(grid[:,:1],x),grid],dim=-1) # [R^2,3]
+            occupied = []
+            for c in range(0,len(coord),cfg.bake.chunk_size):
+                points_3D = range_min+(coord[c:c+cfg.bake.chunk_size]+0.5)*cell_size
+                occupied.append(teacher.forward_density(opt,points_3D)>=cfg.bake.thres)
+            coord = coord[torch.cat(occupied)] # [M,3]
+            for c in range(0,len(coord),chunk_leaves):
+                coord_chunk = coord[c:c+chunk_leaves] # [m,3]
+                # anti-aliased density
+                points_3D = range_min+(coord_chunk[:,None]+torch.rand(len(coord_chunk),cfg.bake.samples,3,device=opt.device))*cell_size # [m,S,3]
+                density.append(teacher.forward_density(opt,points_3D).mean(dim=-1))
+                # colors at the leaf center, the directions broadcast against the points (the geometry is evaluated once)
+                points_3D = range_min+(coord_chunk[:,None]+0.5)*cell_size # [m,1,3]
+                if opt.arch.color=="sh":
+                    # spherical harmonics teachers give the coefficients directly (truncated or zero-padded to the degree)
+                    sh_teacher,_ = teacher.forward_geometry(opt,points_3D[:,0]) # [m,3K']
+                    sh_teacher = sh_teacher.view(len(coord_chunk),3,-1) # [m,3,K']
+                    sh_leaf = sh_teacher.new_zeros(len(coord_chunk),*self.sh.shape[1:]) # [m,3,K]
+                    k = min(sh_teacher.shape[-1],sh_leaf.shape[-1])
+                    sh_leaf[...,:k] = sh_teacher[...,:k]
+                    sh.append(sh_leaf)
+                elif opt.nerf.view_dep:
+                    rgb,_ = teacher.forward(opt,points_3D,ray_unit=dirs[None],mode=None) # [m,K,3]
+                    logit = torch.logit(rgb,eps=1e-4) # [m,K,3]
+                    sh.append((project@logit).transpose(1,2)) # [m,3,(D+1)^2]
+                else:
+                    rgb,_ = teacher.forward(opt,points_3D,mode=None) # [m,1,3]
+                    sh.append(torch.logit(rgb,eps=1e-4).transpose(1,2)) # [m,3,1]
+            coords.append(coord)
+        coords = torch.cat(coords) # [M,3]
+        self.density = torch.cat(density)
+        self.sh = torch.cat(sh)
+        self.nodes = self.build_tree(opt,coords)
+        log.info("baked {} leaves ({:.2f}% of {}^3), {} nodes".format(len(coords),len(coords)/res**3*100,res,len(self.nodes)))
+
+    def build_tree(self,opt,coords): # [M,3]
+        # link the leaves bottom-up: the nodes of each level are the unique parent cells of the level below
+        depth = opt.arch.octree.depth
+        tables = []
+        index = torch.arange(1,len(coords)+1,device=coords.device) # [M] (after the empty leaf)
+        for level in reversed(range(depth)):
+            parent = coords>>1 # [M,3]
+            key = (parent[:,0]*2**level+parent[:,1])*2**level+parent[:,2]
+            key,inverse = key.unique(return_inverse=True)
+            bit = coords&1
+            table = torch.full((len(key),8),-1,dtype=torch.long,device=coords.device) # [N,8]
+            table[inverse,bit[:,0]*4+bit[:,1]*2+bit[:,2]] = index
+            tables.insert(0,table)
+            coords = torch.stack([key//4**level,key//2**level%2**level,key%2**level],dim=-1) # [N,3]
+            index = torch.arange(len(key),device=coords.device)
+        if not len(tables[0]): return torch.full((1,8),-1,dtype=torch.long,device=coords.device)
+        # concatenate the levels, offsetting the node indices (the last level points to the leaves)
+        offset = np.cumsum([len(table) for table in tables])
+        for level in range(depth-1):
+            tables[level] = torch.where(tables[level]>=0,tables[level]+offset[level],tables[level])
+        return torch.cat(tables,dim=0) # [N,8]
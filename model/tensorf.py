@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+import torch.nn.functional as torch_F
+
+import util
+from util import log,debug
+from . import nerf
+
+# ============================ factorized tensor (vector-matrix) radiance field ============================
+
+class NeRF(nerf.NeRF):
+    # TensoRF vector-matrix decomposition: density and appearance as sums of plane x line factors over the
+    # 3 axis splits, decoded by a small MLP (opt.arch.backend=tensorf), with the same forward contract as the MLP NeRF
+
+    plane_axes = [(0,1),(0,2),(1,2)]
+    line_axes = [2,1,0]
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.progress = torch.nn.Parameter(torch.tensor(0.)) # use Parameter so it could be checkpointed (BARF)
+        # checkpoints store the grown factors, resize them before loading
+        self._register_load_state_dict_pre_hook(self.resize_factors_to_state_dict)
+
+    def define_network(self,opt):
+        cfg = opt.arch.tensorf
+        assert(opt.arch.density_activ!="relu" or cfg.density_shift>=0),"a negative density shift leaves no gradient through relu at initialization"
+        res = cfg.res[0]
+        if opt.nerf.view_dep:
+            input_view_dim = 3+6*opt.arch.posenc.L_view if opt.arch.posenc else 3
+        # plane/line factors for each axis split
+        self.density_planes = torch.nn.ParameterList([torch.nn.Parameter(0.1*torch.randn(1,cfg.density_comps,res,res)) for _ in range(3)])
+        self.density_lines = torch.nn.ParameterList([torch.nn.Parameter(0.1*torch.randn(1,cfg.density_comps,res,1)) for _ in range(3)])
+        self.app_planes = torch.nn.ParameterList([torch.nn.Parameter(0.1*torch.randn(1,cfg.app_comps,res,res)) for _ in range(3)])
+        self.app_lines = torch.nn.ParameterList([torch.nn.Parameter(0.1*torch.randn(1,cfg.app_comps,res,1)) for _ in range(3)])
+        # appearance features (or the spherical harmonics colors)
+        app_dim = 3*self.get_num_sh(opt) if opt.arch.color=="sh" else cfg.app_dim
+        self.app_basis = torch.nn.Linear(3*cfg.app_comps,app_dim,bias=False)
+        # RGB prediction
+        self.mlp_rgb = torch.nn.ModuleList()
+        if opt.arch.color=="sh": return
+        L = util.get_layer_dims(cfg.layers_rgb)
+        for li,(k_in,k_out) in enumerate(L):
+            if li==0: k_in = cfg.app_dim+(input_view_dim if opt.nerf.view_dep else 0)
+            linear = torch.nn.Linear(k_in,k_out)
+            if opt.arch.tf_init:
+                self.tensorflow_init_weights(opt,linear,out="all" if li==len(L)-1 else None)
+            self.mlp_rgb.append(linear)
+
+    def get_factors(self):
+        return [*self.density_planes,*self.density_lines,*self.app_planes,*self.app_lines]
+
+    def get_param_groups(self,opt):
+        factors = self.get_factors()
+        head = [p for p in self.parameters() if all(p is not f for f in factors)]
+        return [dict(params=factors,lr=opt.arch.tensorf.lr),dict(params=head,lr=opt.arch.tensorf.lr_head)]
+
+    def forward(self,opt,points_3D,ray_unit=None,mode=None,ray_id=None): # [B,...,3]
+        # ray_unit: either broadcastable to points_3D (e.g. one direction per ray) or per ray and gathered with ray_id
+        density = self.forward_density(opt,points_3D,mode=mode)
+        feat = self.app_basis(self.sample_factors(opt,points_3D,self.app_planes,self.app_lines)) # [B,...,K]
+        if opt.arch.color=="sh":
+            return self.get_sh_color(opt,feat,ray_unit=ray_unit,ray_id=ray_id),density
+        # predict RGB values
+        feat_view = self.get_view_feat(opt,feat.shape[-1],self.encode_view(opt,ray_unit),ray_id=ray_id)
+        feat = self.forward_rgb_layers(opt,range(len(self.mlp_rgb)),feat,feat_view)
+        rgb = feat.sigmoid_() # [B,...,3]
+        return rgb,density
+
+    def forward_density(self,opt,points_3D,mode=None): # [B,...,3]
+        density = self.sample_factors(opt,points_3D,self.density_planes,self.density_lines).sum(dim=-1) # [B,...]
+        density = density+opt.arch.tensorf.density_shift
+        if opt.nerf.density_noise_reg and mode=="train":
+            density += torch.randn_like(density)*opt.nerf.density_noise_reg
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density_activ(density)
+        # empty space outside of the grid
+        range_min,range_max = opt.arch.tensorf.range
+        density = density*((points_3D>=range_min)&(points_3D<=range_max)).all(dim=-1)
+        return density
+
+    def sample_factors(self,opt,points_3D,planes,lines): # [B,...,3]
+        # bilinear/linear interpolation of the plane and line factors, multiplied per component
+        shape = points_3D.shape
+        range_min,range_max = opt.arch.tensorf.range
+        points = (points_3D.reshape(1,-1,1,3)-range_min)/(range_max-range_min)*2-1 # [1,P,1,3]
+        feat = []
+        for plane,line,(a,b),c in zip(planes,lines,self.plane_axes,self.line_axes):
+            coord_plane = points[...,[a,b]] # [1,P,1,2]
+            coord_line = torch.stack([torch.zeros_like(points[...,c]),points[...,c]],dim=-1) # [1,P,1,2]
+            feat_plane = torch_F.grid_sample(plane,coord_plane,align_corners=True) # [1,C,P,1]
+            feat_line = torch_F.grid_sample(line,coord_line,align_corners=True) # [1,C,P,1]
+            feat.append((feat_plane*feat_line)[0,...,0].t()) # [P,C]
+        feat = torch.cat(feat,dim=-1) # [P,3C]
+        return feat.view(*shape[:-1],-1) # [B,...,3C]
+
+    @torch.no_grad()
+    def upsample(self,opt,it):
+        # grow the grid resolution (log-linearly up to the final one) at the given iterations,
+        # replacing the factors by new parameters (autograd keeps the shapes of the used ones)
+        cfg = opt.arch.tensorf
+        if it not in cfg.upsample: return []
+        k = cfg.upsample.index(it)+1
+        res = int(np.round(np.exp(np.log(cfg.res[0])+(np.log(cfg.res[1])-np.log(cfg.res[0]))*k/len(cfg.upsample))))
+        replaced = []
+        for factors in [self.density_planes,self.density_lines,self.app_planes,self.app_lines]:
+            for i,factor in enumerate(factors):
+                size = (res,res) if factor.shape[-1]>1 else (res,1)
+                factors[i] = torch.nn.Parameter(torch_F.interpolate(factor.data,size=size,mode="bilinear",align_corners=True))
+                replaced.append((factor,factors[i]))
+        log.info("grid resolution: {}".format(res))
+        return replaced
+
+    def resize_factors_to_state_dict(self,state_dict,prefix,*args):
+        # (in place, keeping the parameters registered in the optimizer)
+        for name,param in self.named_parameters():
+            key = prefix+name
+            if key in state_dict and state_dict[key].shape!=param.shape:
+                param.data = param.data.new_empty(state_dict[key].shape)
@@ -8,6 +8,7 @@ import ipdb
 import types
 import termcolor
 import socket
+import resource
 import contextlib
 from easydict import EasyDict as edict
 
@@ -91,6 +92,20 @@ def update_timer(opt,timer,ep,it_per_ep):
     timer.it_mean = timer.it_mean*momentum+timer.it*(1-momentum) if timer.it_mean is not None else timer.it
     timer.arrival = timer.it_mean*it_per_ep*(opt.max_epoch-ep)
 
+def get_peak_memory(opt,reset=False):
+    # peak memory (MB): RSS of the process on CPU, allocated memory on GPU
+    if opt.device!="cpu":
+        if reset: torch.cuda.reset_peak_memory_stats(opt.device)
+        return torch.cuda.max_memory_allocated(opt.device)/2**20
+    if reset and os.path.isfile("/proc/self/clear_refs"):
+        # reset the RSS high-water mark (Linux only)
+        with open("/proc/self/clear_refs","w") as file: file.write("5")
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"): return int(line.split()[1])/2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
 # move tensors to device in-place
 def move_to_device(X,device):
     if isinstance(X,dict):
@@ -173,6 +188,24 @@ def get_layer_dims(layers):
     # return a list of tuples (k_in,k_out)
     return list(zip(layers[:-1],layers[1:]))
 
+def get_sh_basis(dirs,degree): # [...,3]
+    # type: (Tensor,int) -> Tensor
+    # real spherical harmonics up to the given degree (at most 3) evaluated at unit directions
+    assert(degree<=3)
+    x,y,z = dirs[...,0],dirs[...,1],dirs[...,2] # [...]
+    xx,yy,zz = x*x,y*y,z*z
+    basis = [torch.full_like(x,0.28209479177387814)]
+    if degree>=1:
+        basis += [-0.4886025119029199*y,0.4886025119029199*z,-0.4886025119029199*x]
+    if degree>=2:
+        basis += [1.0925484305920792*x*y,-1.0925484305920792*y*z,0.31539156525252005*(2*zz-xx-yy),
+                  -1.0925484305920792*x*z,0.5462742152960396*(xx-yy)]
+    if degree>=3:
+        basis += [-0.5900435899266435*y*(3*xx-yy),2.890611442640554*x*y*z,-0.4570457994644658*y*(4*zz-xx-yy),
+                  0.3731763325901154*z*(2*zz-3*xx-3*yy),-0.4570457994644658*x*(4*zz-xx-yy),
+                  1.445305721320277*z*(xx-yy),-0.5900435899266435*x*(xx-3*yy)]
+    return torch.stack(basis,dim=-1) # [...,(D+1)^2]
+
 @contextlib.contextmanager
 def suppress(stdout=False,stderr=False):
     with open(os.devnull,"w") as devnull:
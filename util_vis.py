@@ -1,5 +1,6 @@
 import numpy as np
 import os,sys,time
+import queue,threading
 import torch
 import torch.nn.functional as torch_F
 import torchvision
@@ -41,6 +42,38 @@ def dump_images(opt,idx,name,images,masks=None,from_range=(0,1),cmap="gray"):
         img_uint8 = (img*255).astype(np.uint8)
         imageio.imsave(fname,img_uint8)
 
+class ImageWriter():
+    # encode and save images on a background thread (so that rendering the next image overlaps with the PNG writing)
+
+    def __init__(self,max_queue=8):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            image,fname = item
+            try: torchvision_F.to_pil_image(image).save(fname)
+            except Exception as e: self.error = e
+
+    def save(self,image,fname): # [C,H,W]
+        if self.error is not None: raise self.error
+        self.queue.put((image.detach().cpu(),fname))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None: raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
 def get_heatmap(opt,gray,cmap): # [N,H,W]
     color = plt.get_cmap(cmap)(gray.numpy())
     color = torch.from_numpy(color[...,:3]).permute(0,3,1,2).float() # [N,3,H,W]